@@ -0,0 +1,1122 @@
+#!/usr/bin/env python
+
+'''
+bench_deploy.py - End to end deployment benchmark for k8s.py and ko.py
+
+Purpose
+=======
+
+Give a repeatable number to judge orchestration changes against.
+
+The deployment scripts are run in-process, end to end, with stand-in
+executables for kubectl, helm, kubeadm, nmap, docker, yum, apt-get, pip,
+openstack, nova, git, curl, sudo and friends first on the PATH. Each
+stand-in sleeps for a configurable latency and answers from a small shared
+state file, which scripts a pod lifecycle: kubeadm init creates the
+kube-system pods, the CNI manifest creates the network pod, DNS pods wait
+for the network, helm install creates a pod per chart and so on.
+
+The total time and the time of every k8s_*, kolla_* and helm_* step is
+reported, along with how many times each tool was called.
+
+Scenarios
+=========
+
+baseline:       small, constant latencies
+slow-apiserver: every kubectl and helm call takes half a second
+slow-pulls:     pods take 20 seconds to reach Running
+etcd-timeouts:  the first kubectl get pods calls report "request timed out"
+bad-image:      the images of the kolla pods do not exist, ko.py fails
+busy-subnet:    nine in ten addresses are taken and nmap takes a second
+
+Safety
+======
+
+The stand-in sudo only ever runs other stand-ins, anything else it is
+asked to run as root is skipped. The same goes for the root shell of
+--privileged_helper, a bash that only finds the stand-ins and skips any
+other command. Commands run without sudo are real, and
+the scripts still write their scratch files to /tmp and the working
+directory. Preferably run this in a throwaway VM or container.
+
+The deployment scripts are Python 2, so run this with Python 2 as well:
+
+python bench_deploy.py -t k8s -s baseline slow-pulls
+'''
+
+from __future__ import print_function
+import argparse
+from argparse import RawDescriptionHelpFormatter
+import fcntl
+import glob
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import parse_qs, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Deployment scripts to benchmark, with the arguments to run them with and
+# any stand-in configuration they need
+TARGETS = {
+    'k8s': {
+        'script': 'k8s.py',
+        'argv': ['-hv', '2.11.0'],
+        'config': {'kube_system_pods': 7, 'helm_version': '2.11.0'}},
+    'ko': {
+        'script': 'ko.py',
+        'argv': ['eth0', 'eth1', '-hv', '2.8.1'],
+        'config': {'kube_system_pods': 6, 'helm_version': '2.8.1'}},
+}
+
+# Latencies are in seconds per call, "packages" covers yum, apt-get and apt
+DEFAULT_CONFIG = {
+    'latency': {
+        'kubectl': 0.05,
+        'apiserver': 0.005,
+        'helm': 0.1,
+        'kubeadm': 2.0,
+        'packages': 0.5,
+        'pip': 0.5,
+        'docker': 0.05,
+        'nmap': 0.2,
+        'openstack': 0.2,
+        'curl': 0.1,
+        'git': 0.2,
+        'ansible': 1.0},
+    # Seconds from creation until a pod is Running
+    'pod_ready': 3,
+    # Seconds from creation until a nova server is Running
+    'vm_ready': 5,
+    # Fraction of addresses nmap reports as up
+    'busy': 0.3,
+    # Number of "kubectl get pods" calls answered with an etcd timeout
+    'etcd_timeouts': 0,
+    # The images of the pods in the kolla namespace can not be pulled
+    'bad_image': False,
+    'kube_system_pods': 7,
+    'helm_version': '2.11.0',
+}
+
+SCENARIOS = {
+    'baseline': {},
+    'slow-apiserver': {'latency': {'kubectl': 0.5, 'helm': 0.5,
+                                   'apiserver': 0.5}},
+    'slow-pulls': {'pod_ready': 20},
+    'etcd-timeouts': {'etcd_timeouts': 5},
+    'bad-image': {'bad_image': True},
+    'busy-subnet': {'busy': 0.9, 'latency': {'nmap': 1.0}},
+}
+
+STANDINS = ['kubectl', 'helm', 'kubeadm', 'nmap', 'docker', 'yum', 'apt-get',
+            'apt', 'pip', 'openstack', 'nova', 'neutron', 'git', 'curl', 'ip',
+            'dhclient', 'ansible-playbook', 'kollakube',
+            'kolla-kubernetes-genpwd', 'ssh-keygen', 'sudo']
+
+DISTROS = {
+    'centos': ('CentOS Linux', '7.5.1804', 'Core'),
+    'ubuntu': ('Ubuntu', '16.04', 'xenial'),
+}
+
+KUBE_SYSTEM_PODS = ['etcd-master', 'kube-apiserver-master',
+                    'kube-controller-manager-master',
+                    'kube-scheduler-master', 'kube-proxy-x7k2p',
+                    'coredns-576cbf47c7-8lzvs', 'coredns-576cbf47c7-qp4lc']
+
+# Pods created by "kubectl apply/create -f <file>", by file name
+MANIFEST_PODS = {
+    'weave': ('kube-system', 'weave-net-4xv7q', 'cni'),
+    'canal': ('kube-system', 'canal-9zt2w', 'cni'),
+    'calico': ('kube-system', 'calico-node-2kq8d', 'cni'),
+}
+
+NAMESPACES = ['default', 'kube-public', 'kube-system']
+
+KUBECONFIG = '''apiVersion: v1
+kind: Config
+clusters:
+- cluster:
+    server: http://127.0.0.1:%d
+  name: bench
+contexts:
+- context:
+    cluster: bench
+    user: bench
+  name: bench
+current-context: bench
+users:
+- name: bench
+  user:
+    token: bench
+'''
+
+JOIN_CMD = ('kubeadm join 10.0.0.5:6443 --token abcdef.0123456789abcdef '
+            '--discovery-token-ca-cert-hash sha256:0123456789')
+
+
+def parse_args():
+    '''Parse sys.argv and return args'''
+
+    parser = argparse.ArgumentParser(
+        formatter_class=RawDescriptionHelpFormatter,
+        description='Benchmark k8s.py and ko.py end to end against stand-in '
+        'kubectl, helm, nmap, docker\nand package managers with scripted '
+        'latencies and pod lifecycles.',
+        epilog='E.g.: python bench_deploy.py -t k8s ko -s baseline '
+        'slow-pulls -r 3\n')
+    parser.add_argument('-t', '--targets', nargs='+', default=['k8s'],
+                        choices=sorted(TARGETS),
+                        help='deployment scripts to run, default k8s')
+    parser.add_argument('-s', '--scenarios', nargs='+', default=['baseline'],
+                        choices=sorted(SCENARIOS),
+                        help='scenarios to run, default baseline')
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='number of runs of each target and scenario')
+    parser.add_argument('-d', '--distro', default='centos',
+                        choices=sorted(DISTROS),
+                        help='Linux distribution the scripts should see')
+    parser.add_argument('-a', '--script_args', type=str, default='',
+                        help='extra arguments for the deployment scripts, '
+                        'E.g: "-prof /tmp/trace.json"')
+    parser.add_argument('-o', '--output', type=str,
+                        help='also write the results to this JSON file')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help='keep the benchmark directories, with the '
+                        'script output and stand-in call log')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the output of the deployment scripts')
+
+    return parser.parse_args()
+
+
+#
+# Stand-ins - run as separate processes, see write_standins
+#
+
+
+class State(object):
+    '''Locked read-modify-write access to the shared stand-in state'''
+
+    def __init__(self, bench_dir):
+        self.path = os.path.join(bench_dir, 'state.json')
+
+    def __enter__(self):
+        self.f = open(self.path, 'a+')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        self.f.seek(0)
+        data = self.f.read()
+        if data:
+            self.data = json.loads(data)
+        else:
+            self.data = {'pods': [], 'servers': {}, 'releases': [],
+                         'pod_lists': 0}
+        return(self.data)
+
+    def __exit__(self, *exc):
+        self.f.seek(0)
+        self.f.truncate()
+        json.dump(self.data, self.f)
+        self.f.flush()
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def add_pod(state, namespace, name, role=None, release=None):
+    '''Add a pod to the stand-in cluster, replacing one of the same name'''
+
+    state['pods'] = [p for p in state['pods']
+                     if (p['namespace'], p['name']) != (namespace, name)]
+    state['pods'].append({'namespace': namespace, 'name': name,
+                          'created': time.time(), 'role': role,
+                          'release': release})
+
+
+def select_pods(state, namespace=None, selector=None):
+    '''Return the pods of namespace, all if None, that match selector
+
+    Only the "key=value" and "key in (a,b)" selectors the scripts use are
+    understood, and release is the only label pods have.
+    '''
+
+    values = None
+    if selector:
+        match = re.match(r'(\w+)\s*(?:=|in\s*\()\s*([^)]*)\)?$', selector)
+        values = [v.strip() for v in match.group(2).split(',')]
+        if match.group(1) != 'release':
+            values = []
+    return([p for p in state['pods']
+            if namespace in (None, p['namespace']) and
+            (values is None or p.get('release') in values)])
+
+
+def pod_phase(state, config, pod, now):
+    '''Return the state of pod
+
+    Pending, ContainerCreating, Starting while running but not yet ready,
+    then Running, or Completed for the pod of a Job.
+    '''
+
+    start = pod['created']
+    if pod['role'] == 'dns':
+        # DNS pods only start once the pod network is up
+        cni = [p['created'] + config['pod_ready'] for p in state['pods']
+               if p['role'] == 'cni']
+        if not cni or min(cni) > now:
+            return('Pending')
+        start = max(start, min(cni))
+    elapsed = now - start
+    if config['bad_image'] and pod['namespace'] == 'kolla' and \
+            elapsed >= config['pod_ready'] / 2.0:
+        return('ImagePullBackOff')
+    if elapsed >= config['pod_ready']:
+        return('Completed' if pod['role'] == 'job' else 'Running')
+    if elapsed >= config['pod_ready'] * 0.75 and pod['role'] != 'job':
+        # The containers are up, the readiness probe has yet to pass
+        return('Starting')
+    if elapsed >= config['pod_ready'] / 2.0:
+        return('ContainerCreating')
+    return('Pending')
+
+
+def option(argv, *names):
+    '''Return the value following any of names in argv, or None'''
+
+    for i, arg in enumerate(argv[:-1]):
+        if arg in names:
+            return(argv[i + 1])
+    return(None)
+
+
+def pod_json(state, config, pod, now):
+    '''Return pod as kubectl get pods -o json would'''
+
+    phase = pod_phase(state, config, pod, now)
+    if phase in ('Running', 'Starting'):
+        container = {'ready': phase == 'Running', 'state': {'running': {}}}
+        status = 'Running'
+    elif phase == 'Completed':
+        container = {'ready': False, 'state': {
+            'terminated': {'exitCode': 0, 'reason': 'Completed'}}}
+        status = 'Succeeded'
+    else:
+        container = {'ready': False,
+                     'state': {'waiting': {'reason': phase}}}
+        if phase == 'ImagePullBackOff':
+            container['state']['waiting']['message'] = (
+                'Back-off pulling image "%s"' % pod_image(pod))
+        status = 'Pending'
+    container.update({'name': pod['name'].split('-')[0], 'restartCount': 0})
+    created = time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                            time.gmtime(pod['created']))
+    metadata = {'namespace': pod['namespace'], 'name': pod['name'],
+                'creationTimestamp': created}
+    if pod.get('release'):
+        metadata['labels'] = {'release': pod['release']}
+    if pod['role'] == 'job':
+        metadata['ownerReferences'] = [
+            {'kind': 'Job', 'name': pod['name'].rsplit('-', 1)[0]}]
+    return({'kind': 'Pod',
+            'metadata': metadata,
+            'spec': {'containers': [{'name': container['name']}]},
+            'status': {'phase': status,
+                       'conditions': [{'type': 'Ready',
+                                       'status': str(phase == 'Running')}],
+                       'containerStatuses': [container]}})
+
+
+def pod_image(pod):
+    return('kolla/centos-binary-%s:bench' % pod['name'].rsplit('-', 1)[0])
+
+
+def events_json(state, config, namespace=None):
+    '''Return the events kubectl get events -o json would'''
+
+    items = []
+    now = time.time()
+    for pod in select_pods(state, namespace):
+        if pod_phase(state, config, pod, now) == 'ImagePullBackOff':
+            items.append({
+                'type': 'Warning', 'reason': 'Failed',
+                'involvedObject': {'kind': 'Pod', 'name': pod['name'],
+                                   'namespace': pod['namespace']},
+                'message': 'Failed to pull image "%s": rpc error: code = '
+                'Unknown desc = manifest for %s not found'
+                % (pod_image(pod), pod_image(pod))})
+    return({'kind': 'List', 'items': items,
+            'metadata': {'resourceVersion': ''}})
+
+
+def kubectl_watch_pods(bench_dir, config, argv):
+    '''Stand-in for kubectl get pods -w -o json, runs until killed
+
+    Every pod is printed first, then each pod again when it changes.
+    '''
+
+    namespace = None
+    if '--all-namespaces' not in argv and '-A' not in argv:
+        namespace = option(argv, '-n', '--namespace') or 'default'
+    selector = option(argv, '-l', '--selector')
+    seen = {}
+    while True:
+        with State(bench_dir) as state:
+            now = time.time()
+            pods = [pod_json(state, config, p, now)
+                    for p in select_pods(state, namespace, selector)]
+        for pod in pods:
+            key = (pod['metadata']['namespace'], pod['metadata']['name'])
+            if seen.get(key) != pod:
+                seen[key] = pod
+                print(json.dumps(pod, indent=4))
+        sys.stdout.flush()
+        time.sleep(0.2)
+
+
+def kubectl_get_pods(state, config, argv):
+    '''Output for kubectl get pods'''
+
+    state['pod_lists'] += 1
+    if state['pod_lists'] <= config['etcd_timeouts']:
+        return('Error from server: etcdserver: request timed out', 1)
+
+    all_ns = '--all-namespaces' in argv or '-A' in argv
+    namespace = option(argv, '-n', '--namespace') or 'default'
+    now = time.time()
+    pods = select_pods(state, None if all_ns else namespace,
+                       option(argv, '-l', '--selector'))
+
+    if option(argv, '-o', '--output') == 'json':
+        items = [pod_json(state, config, p, now) for p in pods]
+        return(json.dumps({'kind': 'List', 'items': items,
+                           'metadata': {'resourceVersion': ''}}), 0)
+
+    lines = []
+    if '--no-headers' not in argv:
+        lines.append('NAMESPACE  NAME  READY  STATUS  RESTARTS  AGE'
+                     if all_ns else 'NAME  READY  STATUS  RESTARTS  AGE')
+    for p in pods:
+        phase = pod_phase(state, config, p, now)
+        row = '%s  %s  0  %ds' % (p['name'],
+                                  '1/1' if phase == 'Running' else '0/1',
+                                  now - p['created'])
+        row = row.replace('  0  ', '  %s  0  ' % (
+            'Running' if phase == 'Starting' else phase), 1)
+        if all_ns:
+            row = '%s  %s' % (p['namespace'], row)
+        lines.append(row)
+    return('\n'.join(lines), 0)
+
+
+def nodes_json():
+    '''The single node of the stand-in cluster, as a NodeList has it'''
+
+    return([{'metadata': {'name': socket.gethostname()},
+             'status': {'conditions': [{'type': 'Ready',
+                                        'status': 'True'}]}}])
+
+
+def kubectl(state, config, argv):
+    '''Stand-in for kubectl'''
+
+    verb = argv[0] if argv else ''
+    if verb == 'get' and len(argv) > 1 and argv[1] in ('pods', 'pod', 'po'):
+        return(kubectl_get_pods(state, config, argv))
+    if verb == 'get' and len(argv) > 1 and argv[1] == 'events':
+        all_ns = '--all-namespaces' in argv or '-A' in argv
+        namespace = option(argv, '-n', '--namespace') or 'default'
+        return(json.dumps(events_json(state, config,
+                                      None if all_ns else namespace)), 0)
+    if verb == 'get' and len(argv) > 1 and argv[1] in ('nodes', 'node'):
+        return(json.dumps({'kind': 'NodeList', 'items': nodes_json()}), 0)
+    if verb == 'get' and len(argv) > 1 and argv[1] == 'svc':
+        return('NAME  TYPE  CLUSTER-IP  EXTERNAL-IP  PORT(S)  AGE\n'
+               'horizon  ClusterIP  10.3.3.80  <none>  80/TCP  1m', 0)
+    if verb in ('apply', 'create') and '-f' in argv:
+        manifest = option(argv, '-f')
+        base = os.path.basename(manifest).split('.')[0]
+        if base in MANIFEST_PODS:
+            namespace, name, role = MANIFEST_PODS[base]
+            add_pod(state, namespace, name, role)
+        elif base == 'busybox' and os.path.exists(manifest):
+            name = re.search(r'name: (\S+)', open(manifest).read()).group(1)
+            add_pod(state, 'default', name)
+        return('%s created' % base, 0)
+    if verb == 'delete' and len(argv) > 2 and argv[1] == 'pod':
+        namespace = option(argv, '-n', '--namespace') or 'default'
+        for p in state['pods']:
+            if (p['namespace'], p['name']) == (namespace, argv[2]):
+                p['created'] = time.time()
+        return('pod "%s" deleted' % argv[2], 0)
+    if verb == 'exec' and 'nslookup' in argv:
+        return('Server:    10.96.0.10\nAddress 1: 10.96.0.10\n\n'
+               'Name:      kubernetes\nAddress 1: 10.96.0.1', 0)
+    if verb == 'version':
+        return('Client Version: version.Info{Major:"1", Minor:"12", '
+               'GitVersion:"v1.12.3", GitCommit:"435f92c7"}', 0)
+    return('', 0)
+
+
+def helm(state, config, argv):
+    '''Stand-in for helm'''
+
+    verb = argv[0] if argv else ''
+    if verb == 'init':
+        add_pod(state, 'kube-system', 'tiller-deploy-6fd8d857bc-m5kxq')
+        return('Tiller (the Helm server-side component) has been installed',
+               0)
+    if verb == 'version':
+        return('\n'.join('%s: &version.Version{SemVer:"v%s"}'
+                         % (side, config['helm_version'])
+                         for side in ('Client', 'Server')), 0)
+    if verb == 'install':
+        charts = [a for a in argv[1:] if '/' in a and not a.startswith('/')]
+        chart = os.path.basename(charts[0]) if charts else 'chart'
+        name = option(argv, '--name') or chart
+        namespace = option(argv, '--namespace') or 'default'
+        state['releases'].append(name)
+        add_pod(state, namespace, '%s-0' % name,
+                'job' if name.endswith('-job') else None, name)
+        return('NAME:   %s\nSTATUS: DEPLOYED' % name, 0)
+    if verb == 'list':
+        return('\n'.join(state['releases']), 0)
+    return('', 0)
+
+
+def kubeadm(state, config, argv):
+    '''Stand-in for kubeadm'''
+
+    if argv and argv[0] == 'init':
+        state['pods'] = []
+        for name in KUBE_SYSTEM_PODS[:config['kube_system_pods']]:
+            role = 'dns' if name.startswith('coredns') else None
+            add_pod(state, 'kube-system', name, role)
+        return('Your Kubernetes master has initialized successfully!\n\n'
+               'You can now join any number of machines by running the '
+               'following on each node\nas root:\n\n  %s\n' % JOIN_CMD, 0)
+    if argv and argv[0] == 'reset':
+        state['pods'] = []
+        state['releases'] = []
+    return('', 0)
+
+
+def nmap(state, config, argv):
+    '''Stand-in for nmap -sP, a fixed share of addresses is up
+
+    The target is an address, or a range of the last octet like 10.0.0.2-252.
+    '''
+
+    prefix, last = argv[-1].rsplit('.', 1)
+    first, _, end = last.partition('-')
+    octets = range(int(first), int(end or first) + 1)
+    up = [octet for octet in octets
+          if (octet % 100) < config['busy'] * 100]
+    if len(octets) == 1 and not up:
+        return('Note: Host seems down. If it is really up, but blocking our '
+               'ping probes, try -Pn\nNmap done: 1 IP address (0 hosts up) '
+               'scanned in 0.52 seconds', 0)
+    return(''.join('Nmap scan report for %s.%d\nHost is up (0.00030s '
+                   'latency).\n' % (prefix, octet) for octet in up) +
+           'Nmap done: %d IP addresses (%d hosts up) scanned in 2.05 seconds'
+           % (len(octets), len(up)), 0)
+
+
+def server_json(config, name, created, now):
+    '''A stand-in nova server as the compute API has it'''
+
+    ready = now - created >= config['vm_ready']
+    updated = created + config['vm_ready'] if ready else created
+    return({'id': '1f2e', 'name': name,
+            'status': 'ACTIVE' if ready else 'BUILD',
+            'OS-EXT-STS:power_state': 1 if ready else 0,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                     time.gmtime(updated))})
+
+
+def openstack(state, config, argv):
+    '''Stand-in for openstack and nova'''
+
+    words = ' '.join(argv)
+    if words.startswith('network list'):
+        return('| 6b0bd3a4 | public1 | 2f0f4b1c |', 0)
+    if words.startswith('server create'):
+        state['servers'][argv[-1]] = time.time()
+        return('| name | %s |' % argv[-1], 0)
+    if words.startswith('floating ip create'):
+        return('10.0.1.60', 0)
+    if words.startswith('list'):
+        now = time.time()
+        rows = []
+        for name, created in sorted(state['servers'].items()):
+            if now - created >= config['vm_ready']:
+                rows.append('| 1f2e | %s | ACTIVE | - | Running | '
+                            'demo-net=10.0.0.5 |' % name)
+            else:
+                rows.append('| 1f2e | %s | BUILD | spawning | NOSTATE | |'
+                            % name)
+        return('\n'.join(rows), 0)
+    return('', 0)
+
+
+def git(state, config, argv):
+    '''Stand-in for git clone, builds just enough of a kolla checkout'''
+
+    if not argv or argv[0] != 'clone':
+        return('', 0)
+    repo = os.path.basename(argv[-1])
+    tools = os.path.join(repo, 'tools')
+    for path in (tools, os.path.join(repo, 'ansible'),
+                 os.path.join(repo, 'etc', repo)):
+        if not os.path.exists(path):
+            os.makedirs(path)
+    scripts = {
+        'helm_build_all.sh':
+            '#!/bin/sh\nfor i in $(seq 1 193); do '
+            ': > "$1/bench-chart-$i.tgz"; done\n',
+        'secret-generator.py': 'import sys\n',
+        'build_local_admin_keystonerc.sh':
+            '#!/bin/sh\nprintf "export OS_USERNAME=admin\\n'
+            'export OS_PASSWORD=bench\\nexport OS_PROJECT_NAME=admin\\n'
+            'export OS_AUTH_URL=$BENCH_API/v3\\n" > ~/keystonerc_admin\n'}
+    for name, content in scripts.items():
+        path = os.path.join(tools, name)
+        with open(path, 'w') as w:
+            w.write(content)
+        os.chmod(path, 0o755)
+    return("Cloning into '%s'..." % repo, 0)
+
+
+def curl(state, config, argv):
+    '''Stand-in for curl, writes something plausible to -o'''
+
+    url = [a for a in argv if '://' in a][-1]
+    out = option(argv, '-o')
+    if out is None:
+        return('v1.12.3' if url.endswith('stable.txt') else '', 0)
+    if 'helm-v' in url:
+        # untar() needs a real tarball holding linux-amd64/helm
+        with tarfile.open(out, 'w:gz') as tar:
+            data = b'#!/bin/sh\n'
+            info = tarfile.TarInfo('linux-amd64/helm')
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+    else:
+        with open(out, 'w') as w:
+            w.write('# %s\n' % url)
+    return('', 0)
+
+
+def ip(state, config, argv):
+    '''Stand-in for ip addr and ip route'''
+
+    if argv and argv[0] == 'route':
+        return('default via 10.0.0.1 dev eth0 proto dhcp metric 100', 0)
+    return('2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n'
+           '    inet 10.0.0.5/24 brd 10.0.0.255 scope global eth0', 0)
+
+
+# Sourced by the root shell of the stand-in sudo, see sudo()
+ROOT_SHELL_RC = '''command_not_found_handle() {
+    echo "skipped as root: $*" >> "$BENCH_DIR/calls.log"
+    return 0
+}
+'''
+
+
+def sudo(bench_dir, argv):
+    '''Stand-in for sudo: run other stand-ins, skip anything else
+
+    A root shell, E.g. the privileged helper's "sudo /usr/bin/env HOME=...
+    /bin/bash", is a real bash whose PATH only holds the stand-ins, and
+    which skips any command it can not find.
+    '''
+
+    while argv and argv[0].startswith('-'):
+        if argv[0] == '-v':
+            return(0)
+        if argv[0] in ('-u', '-g'):
+            argv = argv[1:]
+        argv = argv[1:]
+    if argv and argv[0] == '/usr/bin/env' and '/bin/bash' in argv:
+        shell = argv.index('/bin/bash')
+        env = dict(os.environ)
+        env.update(arg.split('=', 1) for arg in argv[1:shell])
+        env['PATH'] = os.path.join(bench_dir, 'bin')
+        env['BASH_ENV'] = os.path.join(bench_dir, 'root_shell.rc')
+        os.execve('/bin/bash', argv[shell:], env)
+    if argv and argv[0] in STANDINS:
+        path = os.path.join(bench_dir, 'bin', argv[0])
+        os.execv(path, [path] + argv[1:])
+    return(0)
+
+
+HANDLERS = {
+    'kubectl': ('kubectl', kubectl),
+    'helm': ('helm', helm),
+    'kubeadm': ('kubeadm', kubeadm),
+    'nmap': ('nmap', nmap),
+    'openstack': ('openstack', openstack),
+    'nova': ('openstack', lambda s, c, a: openstack(s, c, a)),
+    'git': ('git', git),
+    'curl': ('curl', curl),
+    'ip': (None, ip),
+    'docker': ('docker', lambda s, c, a: (
+        'Docker version 18.06.1-ce, build e68fc7a'
+        if a == ['--version'] else '', 0)),
+    'dhclient': (None, lambda s, c, a: (
+        'DHCPACK from 10.0.1.1\nbound to 10.0.1.50 -- renewal in 43200 '
+        'seconds.', 0)),
+    'yum': ('packages', lambda s, c, a: ('Complete!', 0)),
+    'apt-get': ('packages', lambda s, c, a: ('Done', 0)),
+    'apt': ('packages', lambda s, c, a: ('Done', 0)),
+    'pip': ('pip', lambda s, c, a: ('Successfully installed', 0)),
+    'ansible-playbook': ('ansible', lambda s, c, a: ('PLAY RECAP', 0)),
+}
+
+
+def standin(name, argv):
+    '''Entry point of every stand-in executable'''
+
+    bench_dir = os.environ['BENCH_DIR']
+    with open(os.path.join(bench_dir, 'calls.log'), 'a') as log:
+        log.write('%s %s\n' % (name, ' '.join(argv)))
+    if name == 'sudo':
+        sys.exit(sudo(bench_dir, argv))
+    with open(os.path.join(bench_dir, 'config.json')) as f:
+        config = json.load(f)
+
+    latency, handler = HANDLERS.get(name, (None, lambda s, c, a: ('', 0)))
+    time.sleep(config['latency'].get(latency, 0))
+    if name == 'kubectl' and ('-w' in argv or '--watch' in argv):
+        kubectl_watch_pods(bench_dir, config, argv)
+    with State(bench_dir) as state:
+        out, rc = handler(state, config, argv)
+    if out:
+        print(out, file=sys.stdout if rc == 0 else sys.stderr)
+    sys.exit(rc)
+
+
+def write_standins(bin_dir):
+    '''Create the stand-in executables in bin_dir'''
+
+    for name in STANDINS:
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as w:
+            w.write('#!%s\nimport sys\nsys.path.insert(0, %r)\n'
+                    'import bench_deploy\n'
+                    'bench_deploy.standin(%r, sys.argv[1:])\n'
+                    % (sys.executable, HERE, name))
+        os.chmod(path, 0o755)
+
+
+#
+# Stand-in apiserver - runs in the harness, for scripts run with --kube_api
+# or --openstack_api
+#
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    '''Answer the Kubernetes API requests the deployment scripts make'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        except (IOError, OSError):
+            # The script closed a watch it no longer needed
+            pass
+
+    def reply(self, status, body, headers=()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        '''Return (kind, namespace, name, query) of the request'''
+
+        server = self.server
+        with open(os.path.join(server.bench_dir, 'calls.log'), 'a') as log:
+            log.write('apiserver %s %s\n' % (self.command, self.path))
+        time.sleep(server.config['latency'].get('apiserver', 0))
+
+        url = urlparse(self.path)
+        parts = url.path.split('/')[3:]
+        namespace = None
+        if len(parts) > 2 and parts[0] == 'namespaces':
+            namespace = parts[1]
+            parts = parts[2:]
+        name = parts[1] if len(parts) > 1 else None
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        return(parts[0], namespace, name, query)
+
+    def openstack(self):
+        '''Answer the keystone and nova requests of --openstack_api'''
+
+        server = self.server
+        with open(os.path.join(server.bench_dir, 'calls.log'), 'a') as log:
+            log.write('openstack-api %s %s\n' % (self.command, self.path))
+        time.sleep(server.config['latency'].get('apiserver', 0))
+
+        url = urlparse(self.path)
+        if url.path == '/v3/auth/tokens':
+            self.rfile.read(int(self.headers['Content-Length']))
+            compute = 'http://127.0.0.1:%d/compute/v2.1' % \
+                server.server_address[1]
+            return(self.reply(201, {'token': {'catalog': [
+                {'type': 'compute',
+                 'endpoints': [{'interface': 'public',
+                                'region_id': 'RegionOne',
+                                'url': compute}]}]}},
+                [('X-Subject-Token', 'bench-token')]))
+        if self.headers.get('X-Auth-Token') != 'bench-token':
+            return(self.reply(401, {'error': 'Unauthorized'}))
+        since = parse_qs(url.query).get('changes-since', [''])[0]
+        with State(server.bench_dir) as state:
+            servers = [server_json(server.config, name, created, time.time())
+                       for name, created in sorted(state['servers'].items())]
+        self.reply(200, {'servers': [s for s in servers
+                                     if s['updated'] >= since]})
+
+    def do_GET(self):
+        if self.path.startswith('/compute/'):
+            return(self.openstack())
+        kind, namespace, name, query = self.route()
+        if kind == 'pods' and query.get('watch') == 'true':
+            return(self.watch(namespace, int(query['timeoutSeconds']),
+                              query.get('labelSelector')))
+        with State(self.server.bench_dir) as state:
+            now = time.time()
+            if kind == 'pods':
+                items = [pod_json(state, self.server.config, p, now)
+                         for p in select_pods(state, namespace,
+                                              query.get('labelSelector'))]
+            elif kind == 'namespaces':
+                items = [{'metadata': {'name': ns}}
+                         for ns in state.get('namespaces', NAMESPACES)]
+            elif kind == 'events':
+                items = events_json(state, self.server.config,
+                                    namespace)['items']
+            elif kind == 'nodes':
+                items = nodes_json()
+            else:
+                items = []
+        self.reply(200, {'kind': kind[:-1].capitalize() + 'List',
+                         'metadata': {'resourceVersion': '1'},
+                         'items': items})
+
+    def do_POST(self):
+        if self.path.startswith('/v3/'):
+            return(self.openstack())
+        kind, namespace, name, query = self.route()
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        if kind != 'namespaces':
+            return(self.reply(201, body))
+        with State(self.server.bench_dir) as state:
+            namespaces = state.setdefault('namespaces', list(NAMESPACES))
+            if body['metadata']['name'] in namespaces:
+                return(self.reply(409, {'reason': 'AlreadyExists'}))
+            namespaces.append(body['metadata']['name'])
+        self.reply(201, body)
+
+    def do_PATCH(self):
+        kind, namespace, name, query = self.route()
+        body = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        self.reply(200, body)
+
+    def watch(self, namespace, timeout, selector=None):
+        '''Stream a chunk per pod change until timeout or the client goes'''
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # Unlike a real apiserver every pod is sent at first, as the stand-in
+        # has no resource versions to tell what changed since the list
+        seen = {}
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline and not self.server.stopped:
+                with State(self.server.bench_dir) as state:
+                    now = time.time()
+                    pods = [pod_json(state, self.server.config, p, now)
+                            for p in select_pods(state, namespace, selector)]
+                for pod in pods:
+                    key = (pod['metadata']['namespace'],
+                           pod['metadata']['name'])
+                    if seen.get(key) != pod:
+                        kind = 'ADDED' if key not in seen else 'MODIFIED'
+                        seen[key] = pod
+                        data = (json.dumps({'type': kind, 'object': pod}) +
+                                '\n').encode('utf-8')
+                        self.wfile.write(b'%x\r\n' % len(data) + data +
+                                         b'\r\n')
+                        self.wfile.flush()
+                time.sleep(0.2)
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        self.close_connection = True
+
+
+class ApiServer(HTTPServer):
+    '''Stand-in apiserver sharing the stand-in state, on a free port
+
+    Each connection gets a thread. The script keeps its connections alive,
+    so stop() closes them to let their threads end with the run.
+    '''
+
+    def __init__(self, bench_dir, config):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), ApiHandler)
+        self.bench_dir = bench_dir
+        self.config = config
+        self.stopped = False
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.handle_connection,
+                                  args=(request, client_address))
+        thread.daemon = True
+        self.connections.append((thread, request))
+        thread.start()
+
+    def handle_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            # Requests still running when the run ended lost their bench dir
+            if not self.stopped:
+                self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+        for thread, request in self.connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+        for thread, request in self.connections:
+            thread.join()
+
+
+#
+# Harness
+#
+
+
+def load_script(path, name):
+    '''Import a deployment script as a fresh module'''
+
+    sys.dont_write_bytecode = True
+    try:
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    except ImportError:
+        import imp
+        module = imp.load_source(name, path)
+    return(module)
+
+
+def instrument(module, steps):
+    '''Time every k8s_*, kolla_* and helm_* function of module
+
+    Each call appends [name, depth, seconds] to steps, in call order.
+    '''
+
+    depth = [0]
+
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            entry = [name, depth[0], None]
+            steps.append(entry)
+            depth[0] += 1
+            start = time.time()
+            try:
+                return(func(*args, **kwargs))
+            finally:
+                entry[2] = time.time() - start
+                depth[0] -= 1
+        return(wrapper)
+
+    for name, func in list(vars(module).items()):
+        if re.match('(k8s|kolla|helm)_', name) and callable(func):
+            setattr(module, name, timed(name, func))
+
+
+def run_once(target, scenario, args, run):
+    '''Run one deployment against the stand-ins, return its result'''
+
+    spec = TARGETS[target]
+    config = json.loads(json.dumps(DEFAULT_CONFIG))
+    for key, value in list(spec['config'].items()) + \
+            list(SCENARIOS[scenario].items()):
+        if isinstance(value, dict):
+            config[key].update(value)
+        else:
+            config[key] = value
+
+    bench_dir = tempfile.mkdtemp(prefix='bench-%s-%s-' % (target, scenario))
+    bin_dir = os.path.join(bench_dir, 'bin')
+    home = os.path.join(bench_dir, 'home')
+    work = os.path.join(bench_dir, 'work')
+    for path in (bin_dir, os.path.join(home, '.ssh'), work):
+        os.makedirs(path)
+    with open(os.path.join(home, '.ssh', 'id_rsa.pub'), 'w') as w:
+        w.write('ssh-rsa AAAA bench\n')
+    with open(os.path.join(bench_dir, 'config.json'), 'w') as w:
+        json.dump(config, w)
+    with open(os.path.join(bench_dir, 'root_shell.rc'), 'w') as w:
+        w.write(ROOT_SHELL_RC)
+    write_standins(bin_dir)
+    apiserver = ApiServer(bench_dir, config)
+    threading.Thread(target=apiserver.serve_forever).start()
+    os.makedirs(os.path.join(home, '.kube'))
+    with open(os.path.join(home, '.kube', 'config'), 'w') as w:
+        w.write(KUBECONFIG % apiserver.server_address[1])
+
+    saved_env = dict(os.environ)
+    saved_cwd = os.getcwd()
+    saved_argv = sys.argv
+    saved_stdout = sys.stdout
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['HOME'] = home
+    os.environ['BENCH_DIR'] = bench_dir
+    os.environ['BENCH_API'] = 'http://127.0.0.1:%d' % \
+        apiserver.server_address[1]
+    os.chdir(work)
+    output = open(os.path.join(bench_dir, 'output.log'), 'w')
+
+    steps = []
+    error = None
+    start = time.time()
+    try:
+        module = load_script(os.path.join(HERE, spec['script']),
+                             'bench_%s_%d' % (target, run))
+        # Hooks the trace goes through too, so --record and --replay work
+        module.linux_distribution = lambda: DISTROS[args.distro]
+        module.CURL_PATH = os.path.join(bin_dir, 'curl')
+        instrument(module, steps)
+
+        sys.argv = ([spec['script']] + spec['argv'] +
+                    args.script_args.split())
+        if not args.verbose:
+            sys.stdout = output
+        module.main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = 'exit %s' % e.code
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+    finally:
+        total = time.time() - start
+        sys.stdout = saved_stdout
+        sys.argv = saved_argv
+        output.close()
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+        apiserver.stop()
+
+    calls = {}
+    log = os.path.join(bench_dir, 'calls.log')
+    if os.path.exists(log):
+        for line in open(log):
+            tool = line.split()[0]
+            calls[tool] = calls.get(tool, 0) + 1
+
+    if error:
+        print('  %s/%s run %d failed: %s, output ends:'
+              % (target, scenario, run, error))
+        with open(os.path.join(bench_dir, 'output.log')) as f:
+            for line in f.readlines()[-10:]:
+                print('    %s' % line.rstrip())
+
+    for chart in glob.glob('/tmp/bench-chart-*.tgz'):
+        os.remove(chart)
+    if args.keep:
+        print('  Kept %s' % bench_dir)
+    else:
+        shutil.rmtree(bench_dir)
+
+    return({'target': target, 'scenario': scenario, 'run': run,
+            'total': total, 'error': error, 'steps': steps, 'calls': calls})
+
+
+def report(result):
+    '''Print one result as a table of steps'''
+
+    print('\n%s.py / %s / run %d: %.1fs %s'
+          % (result['target'], result['scenario'], result['run'],
+             result['total'],
+             'FAILED (%s)' % result['error'] if result['error'] else 'ok'))
+    print('  Calls: %s' % ', '.join('%s %d' % item for item in
+                                    sorted(result['calls'].items())))
+    print('  %-52s %8s' % ('Step', 'Seconds'))
+    for name, depth, seconds in result['steps']:
+        if seconds is None:
+            continue
+        print('  %-52s %8.2f' % ('  ' * depth + name, seconds))
+
+
+def main():
+    '''Main function.'''
+
+    args = parse_args()
+
+    results = []
+    for target in args.targets:
+        for scenario in args.scenarios:
+            for run in range(args.repeat):
+                result = run_once(target, scenario, args, run)
+                report(result)
+                results.append(result)
+
+    print('\nSummary (median of %d run(s)):' % args.repeat)
+    for target in args.targets:
+        for scenario in args.scenarios:
+            totals = sorted(r['total'] for r in results
+                            if (r['target'], r['scenario']) ==
+                            (target, scenario))
+            failed = len([r for r in results
+                          if (r['target'], r['scenario']) ==
+                          (target, scenario) and r['error']])
+            print('  %-8s %-16s %8.1fs%s'
+                  % (target + '.py', scenario, totals[len(totals) // 2],
+                     '  (%d failed)' % failed if failed else ''))
+
+    if args.output:
+        with open(args.output, 'w') as w:
+            json.dump(results, w, indent=2)
+
+
+if __name__ == '__main__':
+    main()
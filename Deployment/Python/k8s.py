@@ -91,16 +91,55 @@ source ~/.bashrc
 from __future__ import print_function
 import argparse
 from argparse import RawDescriptionHelpFormatter
+import atexit
+import base64
+import calendar
+import collections
+import fcntl
+import functools
+import json
 import logging
 import os
 import platform
+import random
 import re
+import resource
+import select
+import signal
+import socket
+import ssl
+import struct
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 start_time = time.time()
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlencode, urlparse
+except ImportError:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlparse
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
 logger = logging.getLogger(__name__)
 
 # Nasty globals but used universally
@@ -116,6 +155,50 @@ K8S_DESTROY_PROGRESS = 0
 # Store the kubeadm join command, and display to user at end of deployment
 global JOIN_CMD
 
+# Long-lived shell used by run_shell when --coprocess is selected
+global SHELL_COPROCESS
+SHELL_COPROCESS = None
+
+# Root shell that sudo commands are routed to with --privileged_helper
+global PRIVILEGED_HELPER
+PRIVILEGED_HELPER = None
+
+# Trace that commands are recorded to or replayed from, see CommandTrace
+global TRACE
+TRACE = None
+
+# Profile of what commands cost, see CommandProfiler
+global PROFILER
+PROFILER = None
+
+# Kubernetes API client used with --kube_api, see KubeClient
+global KUBE_CLIENT
+KUBE_CLIENT = None
+
+# Time budget of the whole deployment, see Deadline
+global DEADLINE
+DEADLINE = None
+
+# Background cache of every pod, see PodInformer
+global POD_INFORMER
+POD_INFORMER = None
+
+# Default timeout in seconds for classes of command that are known to hang
+# the deployment. Each pattern is matched against the start of the command,
+# after any sudo, and must end at a word. The first match wins
+COMMAND_TIMEOUTS = [
+    (r'kubectl\s+exec', 600),
+    (r'kubectl', 120),
+    (r'helm\s+install', 600),
+    (r'helm', 120),
+    (r'dhclient', 120),
+    (r'nmap', 60),
+]
+
+# The thread the script runs in, the only one that hands the terminal to the
+# commands it runs, see foreground_terminal()
+MAIN_THREAD = threading.current_thread()
+
 
 def set_logging():
     '''Set basic logging format.'''
@@ -129,6 +212,1012 @@ class AbortScriptException(Exception):
     '''Abort the script and clean up before exiting.'''
 
 
+class CommandTimeoutException(AbortScriptException):
+    '''A shell command was killed because it ran for too long.'''
+
+    def __init__(self, cmd, timeout, output=b''):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.output = output
+        super(CommandTimeoutException, self).__init__(
+            'Command "%s" did not finish within %s seconds' % (cmd, timeout))
+
+
+class CommandFailedException(AbortScriptException):
+    '''A shell command run with check=True exited with an error.'''
+
+    def __init__(self, result):
+        self.result = result
+        message = 'Command "%s" failed with exit code %s' % (
+            result.command, result.rc)
+        if result.stderr or result.stdout:
+            message += ': %s' % (result.stderr or result.stdout)
+        super(CommandFailedException, self).__init__(message)
+
+
+class CommandResult(object):
+    '''The outcome of a shell command, see run_result'''
+
+    __slots__ = ('command', 'rc', 'stdout', 'stderr', 'duration')
+
+    def __init__(self, command, rc, stdout, stderr, duration):
+        self.command = command
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration
+
+    def __repr__(self):
+        return('CommandResult(%r, rc=%r, %.2fs)'
+               % (self.command, self.rc, self.duration))
+
+
+class ShellCoprocess(object):
+    '''A long-lived bash process that commands are piped into
+
+    Each command runs in a subshell of the coprocess, so a "cd" or "exit"
+    behaves as it would in a fresh shell, but there is no fork/exec of
+    /bin/sh and no shell startup per command. Output is delimited with a
+    sentinel on both stdout and stderr, the stdout sentinel also carries
+    the exit status of the command.
+
+    prefix is a command the shell is started through, E.g. sudo. On a
+    timeout the signals then go to that command, sudo passes them on.
+    '''
+
+    def __init__(self, prefix=None):
+        self.proc = subprocess.Popen(
+            (prefix or []) + ['/bin/bash', '--noprofile', '--norc'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            close_fds=True,
+            preexec_fn=os.setpgrp)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def run(self, cmd, timeout=None):
+        '''Run cmd in the coprocess and return (out, err, returncode)
+
+        If cmd has not finished after timeout seconds the coprocess and
+        everything it started is killed, it is restarted on next use.
+        Commands from several threads, E.g. PodInformer, take turns.
+        '''
+
+        with self.lock:
+            return(self.run_locked(cmd, timeout))
+
+    def run_locked(self, cmd, timeout):
+        self.count += 1
+        sentinel = '__SHELL_COPROCESS_%d_%d__' % (os.getpid(), self.count)
+
+        # eval keeps a command with unbalanced quotes from swallowing the
+        # sentinel lines and hanging the coprocess
+        script = ("(eval %s) </dev/null\n"
+                  "printf '\\n%s %%d\\n' $?\n"
+                  "printf '\\n%s\\n' >&2\n"
+                  % (shell_quote(cmd), sentinel, sentinel))
+        try:
+            self.proc.stdin.write(script.encode('utf-8'))
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            raise AbortScriptException(
+                'Shell coprocess is not running, cannot run "%s"' % cmd)
+
+        marker = ('\n%s' % sentinel).encode('ascii')
+        out_fd = self.proc.stdout.fileno()
+        err_fd = self.proc.stderr.fileno()
+        bufs = {out_fd: bytearray(), err_fd: bytearray()}
+        ends = {}
+        returncode = None
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+
+        while len(ends) < 2:
+            pending = [fd for fd in (out_fd, err_fd) if fd not in ends]
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            ready = select.select(pending, [], [], wait)[0]
+            if not ready and deadline is not None:
+                self.kill()
+                raise CommandTimeoutException(cmd, timeout,
+                                              bytes(bufs[out_fd]))
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise AbortScriptException(
+                        'Shell coprocess exited unexpectedly running "%s"'
+                        % cmd)
+                buf = bufs[fd]
+                # Only rescan the tail the marker could straddle
+                start = max(0, len(buf) - len(marker) - 16)
+                buf.extend(data)
+                idx = buf.find(marker, start)
+                if idx < 0:
+                    continue
+                tail = buf[idx + len(marker):]
+                if fd == err_fd:
+                    if tail.startswith(b'\n'):
+                        ends[fd] = idx
+                elif tail.endswith(b'\n'):
+                    returncode = int(tail.strip())
+                    ends[fd] = idx
+
+        out = bytes(bufs[out_fd][:ends[out_fd]])
+        err = bytes(bufs[err_fd][:ends[err_fd]])
+        return(out, err, returncode)
+
+    def kill(self):
+        '''Kill the coprocess and any command it is running'''
+
+        if self.proc.poll() is None:
+            kill_process_group(self.proc.pid)
+        self.proc.wait()
+
+    def close(self):
+        '''Stop the coprocess'''
+
+        if self.proc.poll() is None:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+            self.proc.wait()
+
+
+def shell_coprocess():
+    '''Return the shared shell coprocess, starting it on first use'''
+
+    global SHELL_COPROCESS
+    if SHELL_COPROCESS is None or SHELL_COPROCESS.proc.poll() is not None:
+        SHELL_COPROCESS = ShellCoprocess()
+        atexit.register(SHELL_COPROCESS.close)
+    return(SHELL_COPROCESS)
+
+
+def privileged_helper():
+    '''Return the shared root shell, starting it with sudo on first use
+
+    sudo is run once for the whole deployment, so only this asks for a
+    password. HOME is kept as the user's so "~" and "$HOME" in a command
+    mean what they would have meant with a plain sudo.
+    '''
+
+    global PRIVILEGED_HELPER
+    if PRIVILEGED_HELPER is None or \
+            PRIVILEGED_HELPER.proc.poll() is not None:
+        PRIVILEGED_HELPER = ShellCoprocess(
+            ['sudo', '/usr/bin/env', 'HOME=%s' % os.path.expanduser('~')])
+        atexit.register(PRIVILEGED_HELPER.close)
+    return(PRIVILEGED_HELPER)
+
+
+def privileged_command(cmd):
+    '''Return what the privileged helper should run for cmd, or None
+
+    Only a single "sudo [-H] command" is routed to the helper. Anything
+    else stays with a plain sudo: commands with other sudo options, and
+    commands chaining, piping, redirecting or expanding shell variables,
+    as in the helper those parts would run as root too.
+    '''
+
+    match = re.match(r'sudo\s+(-H\s+)?([^-\s].*)$', cmd, re.DOTALL)
+    if match is None:
+        return(None)
+    command = match.group(2)
+    if re.search(r'[;&|<>`\n]|\$', command.replace('$HOME', '')):
+        return(None)
+    if match.group(1):
+        command = 'HOME=%s %s' % (shell_quote(os.path.expanduser('~root')),
+                                  command)
+    return(command)
+
+
+def keep_sudo_alive(interval=60):
+    '''Refresh the sudo timestamp every interval seconds until exit
+
+    Only single sudo commands run by run_shell go to the privileged helper.
+    Commands that pipe, redirect or chain, and those of run_many, use a
+    plain sudo, which would ask for the password again part way through
+    the deployment once the timestamp expired.
+    '''
+
+    stopped = threading.Event()
+
+    def refresh():
+        with open(os.devnull, 'w') as devnull:
+            while not stopped.wait(interval):
+                subprocess.call(['sudo', '-n', '-v'], stdout=devnull,
+                                stderr=devnull)
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        stopped.set()
+        thread.join()
+    atexit.register(stop)
+
+
+class CommandTrace(object):
+    '''Record or replay the results of shell commands and curl
+
+    The trace file starts with a JSON header line holding the random seed
+    and the Linux distribution of the recording host, followed by one JSON
+    line per command with its stdout, stderr, exit code and duration.
+
+    When replaying nothing is executed. Each command is answered with the
+    next recorded result for that same command, and once those run out the
+    last one is repeated, which is what a wait loop polling for a settled
+    state expects. A command that was never recorded aborts the replay.
+
+    Commands are kept with the home directory as ~, so a trace still
+    replays with another home, E.g. that of another bench_deploy.py run.
+    '''
+
+    def __init__(self, path, replaying=False):
+        self.path = path
+        self.replaying = replaying
+        self.results = {}
+        self.home = re.compile(re.escape(os.path.expanduser('~')) +
+                               r'(?=[/\s\'"]|$)')
+        if replaying:
+            with open(path) as trace:
+                self.header = json.loads(trace.readline())
+                for line in trace:
+                    entry = json.loads(line)
+                    self.results.setdefault(entry['cmd'], []).append(entry)
+        else:
+            self.header = {
+                'seed': random.randrange(2 ** 32),
+                'distribution': list(linux_distribution())}
+            self.trace = open(path, 'w')
+            self.write(self.header)
+        random.seed(self.header['seed'])
+
+    def key(self, cmd):
+        '''Return what cmd is kept as in the trace'''
+
+        return(self.home.sub('~', cmd))
+
+    def write(self, entry):
+        self.trace.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        self.trace.flush()
+
+    def record(self, cmd, out, err, returncode, duration, timeout=None):
+        '''Append the result of a command to the trace'''
+
+        entry = {'cmd': self.key(cmd),
+                 'out': out.decode('latin-1'),
+                 'err': err.decode('latin-1'),
+                 'rc': returncode,
+                 't': round(duration, 3)}
+        if timeout is not None:
+            entry['timeout'] = timeout
+        self.write(entry)
+
+    def replay(self, cmd):
+        '''Return the next recorded (out, err, returncode) for cmd
+
+        CommandTimeoutException is raised if the command timed out when it
+        was recorded.
+        '''
+
+        entries = self.results.get(self.key(cmd))
+        if not entries:
+            raise AbortScriptException(
+                'Command "%s" is not in trace %s' % (cmd, self.path))
+        entry = entries[0]
+        if len(entries) > 1:
+            entries.pop(0)
+        out = entry['out'].encode('latin-1')
+        if 'timeout' in entry:
+            raise CommandTimeoutException(cmd, entry['timeout'], out)
+        return(out, entry['err'].encode('latin-1'), entry['rc'])
+
+
+def start_trace(args):
+    '''Start recording or replaying a trace if the user asked for one'''
+
+    global TRACE
+    if args.replay:
+        TRACE = CommandTrace(args.replay, replaying=True)
+    elif args.record:
+        TRACE = CommandTrace(args.record)
+
+
+def replaying():
+    '''True if commands are being served from a trace'''
+
+    return(TRACE is not None and TRACE.replaying)
+
+
+def sleep(seconds):
+    '''time.sleep, except when replaying a trace as nothing will change'''
+
+    if not replaying():
+        mark = profile_start()
+        time.sleep(seconds)
+        profile_end(mark, 'sleep')
+
+
+def linux_distribution():
+    '''platform.linux_distribution of this host, or the recorded one'''
+
+    if replaying():
+        return(tuple(TRACE.header['distribution']))
+    return(platform.linux_distribution())
+
+
+# What is known about the host the deployment runs on, see host_facts().
+# distribution is (name, version, codename) and linux one of centos, ubuntu
+# or container, for CoreOS and Flatcar, None for any other. memory is in
+# bytes and interfaces maps each network interface to its IPv4 address.
+HostFacts = collections.namedtuple(
+    'HostFacts', 'distribution linux container kernel cpus memory '
+    'interfaces boot_id')
+
+
+def read_file(path, default=''):
+    '''Return the stripped contents of a small file, default if unreadable'''
+
+    try:
+        with open(path) as f:
+            return(f.read().strip())
+    except (IOError, OSError):
+        return(default)
+
+
+def interface_address(name):
+    '''Return the IPv4 address of a network interface, None if it has none'''
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # SIOCGIFADDR
+        ifreq = fcntl.ioctl(sock.fileno(), 0x8915,
+                            struct.pack('256s', name[:15].encode('ascii')))
+        return(socket.inet_ntoa(ifreq[20:24]))
+    except (IOError, OSError):
+        return(None)
+    finally:
+        sock.close()
+
+
+def gather_interfaces():
+    '''Return {name: IPv4 address or None} of every network interface'''
+
+    try:
+        names = sorted(os.listdir('/sys/class/net'))
+    except OSError:
+        names = []
+    return(dict((name, interface_address(name)) for name in names))
+
+
+def gather_host_facts():
+    '''Gather the HostFacts of this host, from /proc and /sys'''
+
+    distribution = tuple(linux_distribution())
+    kernel = platform.release()
+    container = re.search('flatcar|coreos', kernel, re.IGNORECASE) is not None
+    if re.search('Centos', distribution[0], re.IGNORECASE):
+        linux = 'centos'
+    elif re.search('Ubuntu', distribution[0], re.IGNORECASE):
+        linux = 'ubuntu'
+    elif container:
+        linux = 'container'
+    else:
+        linux = None
+
+    memory = re.search(r'^MemTotal:\s+(\d+) kB',
+                       read_file('/proc/meminfo'), re.MULTILINE)
+    return(HostFacts(distribution, linux, container, kernel,
+                     os.sysconf('SC_NPROCESSORS_ONLN'),
+                     int(memory.group(1)) * 1024 if memory else None,
+                     gather_interfaces(),
+                     read_file('/proc/sys/kernel/random/boot_id')))
+
+
+def host_facts(args, supported=('centos', 'ubuntu', 'container')):
+    '''Return the HostFacts of this host, gathered once and kept in args
+
+    With --host_facts they are kept in that file too, and read back from it
+    until the host reboots. The interfaces are not kept, as addresses are
+    renewed and interfaces created without a reboot, they are gathered
+    every time. The script exits on a Linux that is not one of supported.
+    '''
+
+    if getattr(args, 'facts', None) is not None:
+        return(args.facts)
+
+    facts = None
+    path = args.host_facts and os.path.expanduser(args.host_facts)
+    if path and not replaying() and os.path.exists(path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            facts = HostFacts(**data)._replace(distribution=tuple(
+                str(part) for part in data['distribution']))
+        except (ValueError, TypeError):
+            # Written by another version, gather them again
+            facts = None
+        if facts is not None and \
+                facts.boot_id != read_file('/proc/sys/kernel/random/boot_id'):
+            facts = None
+        if facts is not None:
+            facts = facts._replace(interfaces=gather_interfaces())
+    if facts is None:
+        facts = gather_host_facts()
+        if path and not replaying():
+            with open(path, 'w') as f:
+                json.dump(facts._replace(interfaces=None)._asdict(), f)
+
+    if facts.linux not in supported:
+        print('Linux "%s" is not supported yet' % facts.distribution[0])
+        sys.exit(1)
+    args.facts = facts
+    return(facts)
+
+
+class CommandProfiler(object):
+    '''Profile the cost of shell commands and curl, see --profile
+
+    Every command is charged its wall time, the CPU time of the processes
+    it ran and the bytes of output it produced, and the totals are kept per
+    command prefix such as "sudo yum install" or "kubectl get pods". Wait
+    loop sleeps are charged to "sleep".
+
+    At exit the most expensive prefixes are printed and a Chrome trace-event
+    file is written, with a span per print_progress step holding a span per
+    command. Load it in chrome://tracing or https://ui.perfetto.dev.
+
+    CPU time is that of finished child processes, so commands run in the
+    --coprocess shell show none until it exits, and the CPU time of a
+    run_many batch is shared out in proportion to wall time.
+    '''
+
+    def __init__(self, path, top=20):
+        self.path = path
+        self.top = top
+        self.origin = time.time()
+        self.events = []
+        self.totals = {}
+        self.step = None
+
+    def cpu(self):
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return(usage.ru_utime + usage.ru_stime)
+
+    def span(self, name, cat, start, duration, tid=0, **extra):
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X',
+                            'ts': int((start - self.origin) * 1000000),
+                            'dur': int(duration * 1000000),
+                            'pid': 1, 'tid': tid, 'args': extra})
+
+    def add(self, cmd, start, wall, cpu, nbytes, tid=0):
+        '''Charge one command to its prefix and add its span'''
+
+        prefix = command_prefix(cmd)
+        total = self.totals.setdefault(prefix, [0, 0.0, 0.0, 0])
+        total[0] += 1
+        total[1] += wall
+        total[2] += cpu
+        total[3] += nbytes
+        self.span(prefix, 'command', start, wall, tid, cmd=cmd,
+                  cpu=round(cpu, 3), bytes=nbytes)
+
+    def begin_step(self, name):
+        '''Start the span of a print_progress step, ending the last one'''
+
+        self.end_step()
+        self.step = (name, time.time())
+
+    def end_step(self):
+        if self.step is not None:
+            name, start = self.step
+            self.span(name, 'step', start, time.time() - start)
+            self.step = None
+
+    def report(self):
+        '''Write the trace file and print the most expensive prefixes'''
+
+        self.end_step()
+        with open(self.path, 'w') as trace:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, trace)
+
+        rows = sorted(self.totals.items(), key=lambda item: -item[1][1])
+        print('Command profile, top %d of %d prefixes by wall time, trace '
+              'written to %s' % (min(self.top, len(rows)), len(rows),
+                                 self.path))
+        print('%6s %9s %8s %10s  %s'
+              % ('Calls', 'Wall s', 'CPU s', 'Bytes', 'Command'))
+        for prefix, (calls, wall, cpu, nbytes) in rows[:self.top]:
+            print('%6d %9.2f %8.2f %10d  %s'
+                  % (calls, wall, cpu, nbytes, prefix))
+
+
+def command_prefix(cmd):
+    '''Reduce a command to the prefix it is profiled under
+
+    E.g: "sudo nmap -sP 10.0.0.4 | grep Host" becomes "sudo nmap -sP".
+    '''
+
+    words = re.split(r'[|;&<>]', cmd)[0].split()
+    prefix = []
+    if words and words[0] == 'sudo':
+        prefix.append('sudo')
+        words = words[1:]
+        while words and words[0].startswith('-'):
+            words = words[1:]
+    if words:
+        prefix.append(os.path.basename(words[0]))
+    for index, word in enumerate(words[1:3]):
+        if not re.match(r'^[a-z][\w.-]*$', word) and \
+                not (index == 0 and re.match(r'^-\w+$', word)):
+            break
+        prefix.append(word)
+    return(' '.join(prefix))
+
+
+def start_profile(args):
+    '''Start profiling commands if the user asked for it'''
+
+    global PROFILER
+    if args.profile:
+        PROFILER = CommandProfiler(args.profile, args.profile_top)
+        atexit.register(PROFILER.report)
+
+
+def profile_start():
+    '''Mark the start of a command, None when not profiling'''
+
+    if PROFILER is None:
+        return(None)
+    return(time.time(), PROFILER.cpu())
+
+
+def profile_end(mark, cmd, nbytes=0):
+    '''Charge the command started at mark to the profile'''
+
+    if mark is not None:
+        start, cpu = mark
+        PROFILER.add(cmd, start, time.time() - start, PROFILER.cpu() - cpu,
+                     nbytes)
+
+
+class DeadlineExceededException(AbortScriptException):
+    '''The --deadline of the whole deployment has passed.'''
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        super(DeadlineExceededException, self).__init__(
+            'Deadline of %s exceeded during "%s"'
+            % (format_duration(deadline.seconds), deadline.step[0]))
+
+
+def parse_duration(text):
+    '''Return the seconds of a duration, E.g: 90, 45m, 1h30m or 1.5h'''
+
+    units = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r'(\d+(?:\.\d+)?)([hms]?)', text)
+    if not parts or ''.join(n + u for n, u in parts) != text.strip():
+        raise argparse.ArgumentTypeError('invalid duration "%s"' % text)
+    return(sum(float(number) * units[unit] for number, unit in parts))
+
+
+def format_duration(seconds):
+    '''Format seconds as parse_duration reads them, E.g: 31m12s'''
+
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return('%ds' % seconds)
+    if seconds < 3600:
+        return('%dm%02ds' % divmod(seconds, 60))
+    return('%dh%02dm' % divmod(seconds // 60, 60))
+
+
+class Deadline(object):
+    '''Time budget of the whole deployment, see --deadline
+
+    Every wait and every command timeout is cut to what is left of the
+    budget, see time_left(), and the next print_progress step aborts once
+    it is spent. The time each step took is kept for the report printed at
+    exit, with what ran before the first step charged to "Startup".
+    '''
+
+    def __init__(self, seconds, top=10):
+        self.seconds = seconds
+        self.top = top
+        self.start = time.time()
+        self.step = ('Startup', self.start)
+        self.steps = []
+
+    def remaining(self):
+        return(max(0, self.seconds - (time.time() - self.start)))
+
+    def check(self):
+        '''Raise DeadlineExceededException if the budget is spent'''
+
+        if self.remaining() == 0:
+            raise DeadlineExceededException(self)
+
+    def begin_step(self, name):
+        '''Charge the time since the last step to it, and start the next'''
+
+        self.end_step()
+        self.step = (name, time.time())
+
+    def end_step(self):
+        name, start = self.step
+        self.steps.append((name, time.time() - start))
+        self.step = (name, time.time())
+
+    def report(self):
+        '''Print how much of the budget each phase and step used'''
+
+        self.end_step()
+        used = time.time() - self.start
+        if self.remaining() == 0:
+            print('Deadline of %s exceeded, %s used'
+                  % (format_duration(self.seconds), format_duration(used)))
+        else:
+            print('Deadline of %s, %s used, %s left'
+                  % (format_duration(self.seconds), format_duration(used),
+                     format_duration(self.remaining())))
+
+        # A phase is the process a step is printed under, E.g: Kolla
+        phases = collections.OrderedDict()
+        for name, seconds in self.steps:
+            phase = name.split(' - ')[0]
+            phases[phase] = phases.get(phase, 0) + seconds
+        print('%9s %7s  %s' % ('Seconds', 'Budget', 'Phase'))
+        for phase, seconds in phases.items():
+            print('%9.1f %6.1f%%  %s'
+                  % (seconds, 100.0 * seconds / self.seconds, phase))
+
+        rows = sorted(self.steps, key=lambda step: -step[1])[:self.top]
+        print('%9s %7s  %s' % ('Seconds', 'Budget', 'Longest steps'))
+        for name, seconds in rows:
+            print('%9.1f %6.1f%%  %s'
+                  % (seconds, 100.0 * seconds / self.seconds, name))
+
+
+def start_deadline(args):
+    '''Start the time budget if the user gave a deadline'''
+
+    global DEADLINE
+    if args.deadline:
+        DEADLINE = Deadline(args.deadline)
+        atexit.register(DEADLINE.report)
+
+
+def time_left(timeout=None):
+    '''Return timeout cut to what is left of --deadline
+
+    None, for no timeout, becomes what is left. Without a deadline timeout
+    is returned as it is.
+    '''
+
+    if DEADLINE is None:
+        return(timeout)
+    DEADLINE.check()
+    if timeout is None:
+        return(DEADLINE.remaining())
+    return(min(timeout, DEADLINE.remaining()))
+
+
+class KubeApiException(AbortScriptException):
+    '''The Kubernetes API server refused a request.'''
+
+    def __init__(self, status, reason, body=b''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+        super(KubeApiException, self).__init__(
+            'Kubernetes API error %s %s: %s' % (status, reason, body))
+
+
+def read_kubeconfig(path):
+    '''Return the server and credentials of a kubeconfig file
+
+    PyYAML is used to follow the current context when it is installed.
+    Without it the first of each field is taken, which is right for a
+    single cluster file like the admin.conf kubeadm writes.
+    '''
+
+    with open(path) as f:
+        text = f.read()
+
+    if yaml is not None:
+        config = yaml.safe_load(text)
+
+        def named(section, name):
+            for entry in config.get(section) or []:
+                if entry['name'] == name:
+                    return(entry[section[:-1]])
+            return({})
+
+        context = named('contexts', config.get('current-context'))
+        if not context and config.get('contexts'):
+            context = config['contexts'][0]['context']
+        fields = dict(named('clusters', context.get('cluster')))
+        fields.update(named('users', context.get('user')))
+        return(fields)
+
+    fields = {}
+    for key, value in re.findall(r'^\s*([\w-]+):\s*(\S+)\s*$', text,
+                                 re.MULTILINE):
+        fields.setdefault(key, value.strip('"\''))
+    return(fields)
+
+
+class KubeClient(object):
+    '''Minimal Kubernetes REST client, see --kube_api
+
+    The server and credentials come from a kubeconfig file, by default the
+    ~/.kube/config that k8s_load_kubeadm_creds writes. Connections to the
+    apiserver are kept alive and pooled, so a request costs a round trip
+    rather than a kubectl start and a TLS handshake.
+
+    Only the resources the deployment needs are known, see KINDS.
+    '''
+
+    # Resource name: namespaced
+    KINDS = {'pods': True, 'configmaps': True, 'secrets': True,
+             'events': True, 'namespaces': False, 'nodes': False}
+
+    def __init__(self, path=None):
+        config = read_kubeconfig(path or os.path.expanduser('~/.kube/config'))
+        url = urlparse(config['server'])
+        self.host = url.hostname
+        self.port = url.port
+        self.context = None
+        self.headers = {'Accept': 'application/json'}
+        if config.get('token'):
+            self.headers['Authorization'] = 'Bearer %s' % config['token']
+        if url.scheme == 'https':
+            self.context = self.ssl_context(config)
+        self.pool = []
+        self.lock = threading.Lock()
+
+    def ssl_context(self, config):
+        context = ssl.create_default_context()
+        # The certificate is checked against the cluster's own CA. The
+        # apiserver is usually reached by IP address, which Python 2
+        # cannot match against a certificate, so names are not checked.
+        context.check_hostname = False
+        if config.get('insecure-skip-tls-verify'):
+            context.verify_mode = ssl.CERT_NONE
+        elif config.get('certificate-authority-data'):
+            context.load_verify_locations(cadata=base64.b64decode(
+                config['certificate-authority-data']).decode('ascii'))
+        elif config.get('certificate-authority'):
+            context.load_verify_locations(config['certificate-authority'])
+
+        if config.get('client-certificate-data'):
+            # The ssl module only loads key pairs from files
+            paths = []
+            try:
+                for key in ('client-certificate-data', 'client-key-data'):
+                    fd, path = tempfile.mkstemp()
+                    paths.append(path)
+                    os.write(fd, base64.b64decode(config[key]))
+                    os.close(fd)
+                context.load_cert_chain(paths[0], paths[1])
+            finally:
+                for path in paths:
+                    os.remove(path)
+        elif config.get('client-certificate'):
+            context.load_cert_chain(config['client-certificate'],
+                                    config.get('client-key'))
+        return(context)
+
+    def connect(self, timeout=60):
+        if self.context is not None:
+            return(httplib.HTTPSConnection(self.host, self.port,
+                                           timeout=timeout,
+                                           context=self.context))
+        return(httplib.HTTPConnection(self.host, self.port, timeout=timeout))
+
+    def path(self, kind, namespace=None, name=None, **query):
+        '''Return the URL path of a resource kind, or of one resource'''
+
+        if kind not in self.KINDS:
+            raise AbortScriptException('Unknown Kubernetes kind %s' % kind)
+        path = '/api/v1'
+        if namespace is not None and self.KINDS[kind]:
+            path += '/namespaces/%s' % namespace
+        path += '/%s' % kind
+        if name is not None:
+            path += '/%s' % name
+        query = dict((k, v) for k, v in query.items() if v is not None)
+        if query:
+            path += '?' + urlencode(sorted(query.items()))
+        return(path)
+
+    def request(self, method, path, body=None,
+                content_type='application/json'):
+        '''Send a request over a pooled connection, return the parsed reply
+
+        A pooled connection the server has since closed is retried once on
+        a new connection. KubeApiException is raised for an error status.
+        '''
+
+        headers = dict(self.headers)
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = content_type
+        while True:
+            with self.lock:
+                conn = self.pool.pop() if self.pool else None
+            reused = conn is not None
+            if not reused:
+                conn = self.connect()
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            break
+
+        with self.lock:
+            self.pool.append(conn)
+        if response.status >= 400:
+            raise KubeApiException(response.status, response.reason, data)
+        return(json.loads(data.decode('utf-8')))
+
+    def get(self, kind, name, namespace=None):
+        return(self.request('GET', self.path(kind, namespace, name)))
+
+    def list(self, kind, namespace=None, selector=None):
+        '''List resources, of all namespaces unless one is given'''
+
+        return(self.request('GET', self.path(kind, namespace,
+                                             labelSelector=selector)))
+
+    def create(self, kind, body, namespace=None):
+        return(self.request('POST', self.path(kind, namespace), body))
+
+    def patch(self, kind, name, body, namespace=None):
+        '''Merge body into an existing resource'''
+
+        return(self.request('PATCH', self.path(kind, namespace, name), body,
+                            'application/merge-patch+json'))
+
+    def apply(self, kind, body, namespace=None):
+        '''Create a resource, or merge body into it if it already exists'''
+
+        try:
+            return(self.create(kind, body, namespace))
+        except KubeApiException as e:
+            if e.status != 409:
+                raise
+        return(self.patch(kind, body['metadata']['name'], body, namespace))
+
+    def watch(self, kind, namespace=None, resource_version=None,
+              timeout=None, selector=None):
+        '''Yield (type, object) for each change to a kind of resource
+
+        The watch starts after resource_version, E.g. that of a list, and
+        the server ends it after timeout seconds. It has a connection of
+        its own which is closed when the caller stops reading.
+        '''
+
+        conn = self.connect(timeout=(timeout or 0) + 30)
+        path = self.path(kind, namespace, watch='true',
+                         resourceVersion=resource_version,
+                         timeoutSeconds=int(timeout) if timeout else None,
+                         labelSelector=selector)
+        try:
+            conn.request('GET', path, None, self.headers)
+            response = conn.getresponse()
+            if response.status >= 400:
+                raise KubeApiException(response.status, response.reason,
+                                       response.read())
+            for line in self.stream_lines(response):
+                event = json.loads(line.decode('utf-8'))
+                yield((event['type'], event['object']))
+        finally:
+            conn.close()
+
+    def stream_lines(self, response):
+        '''Yield the lines of a response body as they arrive
+
+        Python 2's httplib cannot read part of a chunked body without
+        blocking for more, so the chunks are read here.
+        '''
+
+        if response.getheader('transfer-encoding', '').lower() != 'chunked':
+            for line in response.read().splitlines():
+                if line.strip():
+                    yield(line)
+            return
+
+        buf = b''
+        while True:
+            size = int(response.fp.readline().split(b';')[0], 16)
+            if size == 0:
+                break
+            buf += response.fp.read(size)
+            response.fp.readline()
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                if line.strip():
+                    yield(line)
+        if buf.strip():
+            yield(buf)
+
+
+def kube_client():
+    '''Return the shared Kubernetes API client, creating it on first use'''
+
+    global KUBE_CLIENT
+    if KUBE_CLIENT is None:
+        KUBE_CLIENT = KubeClient()
+    return(KUBE_CLIENT)
+
+
+def kube_age(timestamp):
+    '''Return the age of a resource as kubectl shows it, E.g: 5m'''
+
+    if not timestamp:
+        return('<unknown>')
+    seconds = time.time() - calendar.timegm(
+        time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+    for unit, size, limit in (('s', 1, 120), ('m', 60, 120),
+                              ('h', 3600, 48)):
+        if seconds < size * limit:
+            return('%d%s' % (max(0, seconds) // size, unit))
+    return('%dd' % (seconds // 86400))
+
+
+def resource_table(listing, namespaces=False):
+    '''Format a list of resources much like kubectl get does'''
+
+    # kubectl lists any kind as a List of items that say what they are
+    pods = listing.get('kind') == 'PodList' or \
+        [item.get('kind') for item in listing['items']][:1] == ['Pod']
+    rows = []
+    for item in listing['items']:
+        meta = item['metadata']
+        row = [meta['name']]
+        if namespaces:
+            row.insert(0, meta.get('namespace', ''))
+        if pods:
+            statuses = item['status'].get('containerStatuses', [])
+            row += ['%d/%d' % (len([c for c in statuses if c['ready']]),
+                               len(item['spec']['containers'])),
+                    pod_status(item),
+                    str(sum(c['restartCount'] for c in statuses))]
+        row.append(kube_age(meta.get('creationTimestamp')))
+        rows.append(row)
+
+    header = ['NAME']
+    if namespaces:
+        header.insert(0, 'NAMESPACE')
+    if pods:
+        header += ['READY', 'STATUS', 'RESTARTS']
+    header.append('AGE')
+    return(format_columns([header] + rows))
+
+
+def format_columns(rows):
+    '''Left align rows of cells into columns, the first row is a header'''
+
+    widths = [max(len(row[i]) for row in rows) + 3
+              for i in range(len(rows[0]))]
+    return('\n'.join(''.join(cell.ljust(width)
+                             for cell, width in zip(row, widths)).rstrip()
+                     for row in rows))
+
+
 def parse_args():
     '''Parse sys.argv and return args'''
 
@@ -161,34 +1250,247 @@ def parse_args():
     parser.add_argument('-d', '--destroy', action='store_true',
                         help='destroy existing Kubernetes cluster '
                         'before creating a new one.')
+    parser.add_argument('-cp', '--coprocess', action='store_true',
+                        help='run commands through one long-lived bash '
+                        'coprocess instead of a new shell per command')
+    parser.add_argument('-ph', '--privileged_helper', action='store_true',
+                        help='start one root shell with sudo and run sudo '
+                        'commands in it instead of a sudo per command')
+    parser.add_argument('-ka', '--kube_api', action='store_true',
+                        help='talk to the Kubernetes API directly instead of '
+                        'running kubectl to list and watch pods and show the '
+                        'deployment')
+    parser.add_argument('-inf', '--informer', action='store_true',
+                        help='keep one watch of every pod running in the '
+                        'background, and serve the pod waits and listings '
+                        'from it instead of each asking kubernetes')
+    parser.add_argument('-hf', '--host_facts', type=str,
+                        help='keep the facts gathered about this host in this '
+                        'file, they are gathered again once the host '
+                        'reboots')
+    parser.add_argument('-vc', '--versions_cache', type=str,
+                        help='keep the versions of the installed tools in '
+                        'this file, a tool is probed again once its binary '
+                        'changes')
+    parser.add_argument('-to', '--timeout', type=int,
+                        help='kill any command that takes longer than this '
+                        'many seconds, without it commands known to hang, '
+                        'like "kubectl exec", still have a timeout')
+    parser.add_argument('-rec', '--record', type=str,
+                        help='record every command and its results to this '
+                        'trace file')
+    parser.add_argument('-rep', '--replay', type=str,
+                        help='replay a recorded trace file instead of '
+                        'running any commands')
+    parser.add_argument('-sl', '--stream_log', type=str,
+                        help='append the output of long running commands '
+                        'to this file as it arrives')
+    parser.add_argument('-prof', '--profile', type=str,
+                        help='profile the cost of every command, print the '
+                        'most expensive at exit and write a Chrome trace '
+                        'to this file')
+    parser.add_argument('-pt', '--profile_top', type=int, default=20,
+                        help='number of command prefixes the profile shows')
+    parser.add_argument('-dl', '--deadline', type=parse_duration,
+                        help='abort the deployment if it has not finished '
+                        'within this time, E.g: 45m or 1h30m, and print how '
+                        'much of it each phase used at exit')
 
     return parser.parse_args()
 
 
-def run_shell(args, cmd):
+def run_shell(args, cmd, timeout=None, check=False):
     '''Run a shell command and return the output
 
     Print the output and errors if debug is enabled
     Not using logger.debug as a bit noisy for this info
+
+    cmd may also be an argv list, which is run without a shell. The
+    command, and anything it starts, is killed if it runs for longer than
+    its timeout, see command_timeout(). CommandTimeoutException is raised
+    when that happens. With check set CommandFailedException is raised if
+    the command exits with an error.
     '''
-    debug = False
-    if args.verbose == 10:  # Hack - debug enabled
-        debug = True
 
-    if debug is True or args.commmands:
+    return(run_result(args, cmd, timeout, check).stdout)
+
+
+def run_result(args, cmd, timeout=None, check=False):
+    '''Run a shell command as run_shell does and return a CommandResult
+
+    The result holds the exit code and stderr as well as the output, so
+    callers can tell a failure apart from an empty answer straight away.
+    '''
+
+    line = command_line(cmd)
+    print_shell_cmd(args, line)
+    mark = profile_start()
+    start = time.time()
+    try:
+        out, err, returncode = execute_shell(args, cmd, timeout)
+    except CommandTimeoutException as e:
+        profile_end(mark, line, len(e.output))
+        raise
+    profile_end(mark, line, len(out) + len(err))
+
+    result = CommandResult(line, returncode,
+                           shell_output(args, line, out, err), err.rstrip(),
+                           time.time() - start)
+    if check and returncode != 0:
+        raise CommandFailedException(result)
+    return(result)
+
+
+def execute_shell(args, cmd, timeout=None):
+    '''Run a shell command and return (out, err, returncode)
+
+    The result is served from the trace when one is being replayed, and
+    added to it when one is being recorded. An argv list is run without a
+    shell, except by the --coprocess shell. With --privileged_helper sudo
+    commands are run by the privileged helper, see privileged_command().
+    '''
+
+    argv = None
+    if isinstance(cmd, list):
+        argv = cmd
+        cmd = command_line(argv)
+    timeout = command_timeout(args, cmd, timeout)
+    if replaying():
+        return(TRACE.replay(cmd))
+
+    privileged = None
+    if args.privileged_helper:
+        privileged = privileged_command(cmd)
+
+    start = time.time()
+    try:
+        if privileged is not None:
+            try:
+                out, err, returncode = privileged_helper().run(privileged,
+                                                               timeout)
+            except CommandTimeoutException as e:
+                raise CommandTimeoutException(cmd, timeout, e.output)
+        elif args.coprocess:
+            out, err, returncode = shell_coprocess().run(cmd, timeout)
+        else:
+            terminal = foreground_terminal()
+            p = subprocess.Popen(
+                argv or cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=argv is None,
+                preexec_fn=own_process_group(terminal))
+            timer = ProcessGroupTimer(p, timeout)
+            out, err = p.communicate()
+            timer.cancel()
+            take_terminal(terminal, p)
+            returncode = p.returncode
+            if timer.fired:
+                raise CommandTimeoutException(cmd, timeout, out)
+    except CommandTimeoutException as e:
+        if TRACE is not None:
+            TRACE.record(cmd, e.output, b'', None, time.time() - start,
+                         timeout)
+        raise
+
+    if TRACE is not None:
+        TRACE.record(cmd, out, err, returncode, time.time() - start)
+    return(out, err, returncode)
+
+
+def command_line(cmd):
+    '''The shell command line for cmd, which may be an argv list'''
+
+    if isinstance(cmd, list):
+        return(' '.join(shell_quote(arg) for arg in cmd))
+    return(cmd)
+
+
+def run_cmd(args, argv, *stages, **kwargs):
+    '''Run a command without a shell and post-process its output in Python
+
+    argv is a list as for subprocess. The output lines are passed through
+    each of stages in turn instead of being piped through more processes,
+    see grep(), field(), cut() and count(). E.g:
+
+    run_cmd(args, ['kubectl', 'get', 'pods', '--no-headers'],
+            grep('Running', invert=True), count())
+
+    does the work of 'kubectl get pods --no-headers | grep -v "Running" |
+    wc -l' with one process. A timeout and check can be given as for
+    run_shell.
+
+    Return the remaining lines joined by newlines, or the count.
+    '''
+
+    out = run_shell(args, argv, kwargs.get('timeout'),
+                    kwargs.get('check', False))
+    if not isinstance(out, str):
+        out = out.decode('utf-8', 'replace')
+    lines = out.splitlines()
+    for stage in stages:
+        lines = stage(lines)
+    if isinstance(lines, list):
+        return('\n'.join(lines))
+    return(lines)
+
+
+def grep(pattern, invert=False, ignorecase=False):
+    '''run_cmd stage keeping the lines that match pattern, like grep'''
+
+    regex = re.compile(pattern, re.IGNORECASE if ignorecase else 0)
+    return(lambda lines: [line for line in lines
+                          if bool(regex.search(line)) != invert])
+
+
+def field(number):
+    '''run_cmd stage keeping whitespace separated field number, like awk
+
+    Fields count from 1 as with awk's $1, lines that are too short are
+    dropped.
+    '''
+
+    return(lambda lines: [line.split()[number - 1] for line in lines
+                          if len(line.split()) >= number])
+
+
+def cut(number, delimiter):
+    '''run_cmd stage keeping field number of each line, like cut -d -f
+
+    As with cut, lines without the delimiter are kept whole.
+    '''
+
+    def stage(lines):
+        kept = []
+        for line in lines:
+            if delimiter in line:
+                fields = line.split(delimiter)
+                line = fields[number - 1] if len(fields) >= number else ''
+            kept.append(line)
+        return(kept)
+    return(stage)
+
+
+def count():
+    '''run_cmd stage counting the lines, like wc -l'''
+
+    return(len)
+
+
+def print_shell_cmd(args, cmd):
+    '''Display a shell command before it is run, if asked to'''
+
+    if args.verbose == 10 or args.commmands:  # Hack - debug enabled
         print('  CMD: "%s"' % str(cmd))
 
-    p = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        shell=True)
-    out, err = p.communicate()
+
+def shell_output(args, cmd, out, err):
+    '''Display and tidy up the output of a finished shell command'''
 
     out = out.rstrip()
     err = err.rstrip()
 
-    if debug is True:
+    if args.verbose == 10:  # Hack - debug enabled
         if str(out) is not '0' and str(out) is not '1' and out:
             print('  Shell STDOUT output:')
             print()
@@ -202,9 +1504,396 @@ def run_shell(args, cmd):
     return(out)
 
 
+def run_many(args, cmds, limit=4, timeout=None):
+    '''Run independent shell commands concurrently and return the outputs
+
+    At most limit commands run at once. The outputs are returned in the same
+    order as cmds, tidied up just like run_shell would. The commands always
+    get their own shell, --coprocess only applies to run_shell. Each command
+    gets its own timeout as with run_shell, CommandTimeoutException is
+    raised for the first one that timed out once all of them have finished.
+
+    Python 2 has no asyncio so a small pool of threads is used instead.
+    '''
+
+    cmds = list(cmds)
+    if replaying():
+        results = [TRACE.replay(cmd) for cmd in cmds]
+        return([shell_output(args, cmd, out, err)
+                for cmd, (out, err, returncode) in zip(cmds, results)])
+
+    timeouts = [command_timeout(args, cmd, timeout) for cmd in cmds]
+    for cmd in cmds:
+        print_shell_cmd(args, cmd)
+
+    mark = profile_start()
+    if asyncio is None:
+        results, expired = run_many_threads(cmds, limit, timeouts)
+    else:
+        results, expired = run_many_asyncio(cmds, limit, timeouts)
+
+    if mark is not None:
+        start, cpu = mark
+        cpu = PROFILER.cpu() - cpu
+        wall = sum(result[3] for result in results) or 1
+        for index, cmd in enumerate(cmds):
+            out, err, returncode, duration = results[index]
+            PROFILER.add(cmd, start, duration, cpu * duration / wall,
+                         len(out) + len(err), index + 1)
+
+    if TRACE is not None:
+        for index, cmd in enumerate(cmds):
+            out, err, returncode, duration = results[index]
+            if expired[index]:
+                TRACE.record(cmd, out, err, None, duration, timeouts[index])
+            else:
+                TRACE.record(cmd, out, err, returncode, duration)
+
+    for index, cmd in enumerate(cmds):
+        if expired[index]:
+            raise CommandTimeoutException(cmd, timeouts[index],
+                                          results[index][0])
+
+    return([shell_output(args, cmd, out, err)
+            for cmd, (out, err, returncode, duration) in zip(cmds, results)])
+
+
+def run_many_asyncio(cmds, limit, timeouts):
+    '''Run cmds on an asyncio event loop
+
+    Return [(out, err, returncode, duration), ...] and a list of flags for
+    which commands timed out
+
+    Written with callbacks rather than coroutines so this file still parses
+    with Python 2.
+    '''
+
+    loop = asyncio.new_event_loop()
+    done = loop.create_future()
+    results = [None] * len(cmds)
+    expired = [False] * len(cmds)
+    starts = [None] * len(cmds)
+    queue = list(enumerate(cmds))
+    queue.reverse()
+    state = {'running': 0}
+
+    def fail(exc):
+        if not done.done():
+            done.set_exception(exc)
+
+    def start_next():
+        while queue and state['running'] < limit:
+            index, cmd = queue.pop()
+            state['running'] += 1
+            starts[index] = time.time()
+            task = loop.create_task(asyncio.create_subprocess_exec(
+                '/bin/sh', '-c', cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                preexec_fn=os.setpgrp))
+            task.add_done_callback(functools.partial(started, index))
+        if not state['running'] and not done.done():
+            done.set_result(results)
+
+    def expire(index, proc):
+        expired[index] = True
+        kill_process_group(proc.pid)
+
+    def started(index, task):
+        if task.exception() is not None:
+            return(fail(task.exception()))
+        proc = task.result()
+        timer = None
+        if timeouts[index]:
+            timer = loop.call_later(timeouts[index], expire, index, proc)
+        comm = loop.create_task(proc.communicate())
+        comm.add_done_callback(
+            functools.partial(finished, index, proc, timer))
+
+    def finished(index, proc, timer, task):
+        if timer is not None:
+            timer.cancel()
+        if task.exception() is not None:
+            return(fail(task.exception()))
+        out, err = task.result()
+        results[index] = (out, err, proc.returncode,
+                          time.time() - starts[index])
+        state['running'] -= 1
+        start_next()
+
+    try:
+        loop.call_soon(start_next)
+        return(loop.run_until_complete(done), expired)
+    finally:
+        loop.close()
+
+
+def run_many_threads(cmds, limit, timeouts):
+    '''Run cmds from a pool of threads
+
+    Return [(out, err, returncode, duration), ...] and a list of flags for
+    which commands timed out
+    '''
+
+    results = [None] * len(cmds)
+    expired = [False] * len(cmds)
+    queue = list(enumerate(cmds))
+    queue.reverse()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                index, cmd = queue.pop()
+            start = time.time()
+            p = subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                shell=True,
+                preexec_fn=os.setpgrp)
+            timer = ProcessGroupTimer(p, timeouts[index])
+            out, err = p.communicate()
+            timer.cancel()
+            results[index] = (out, err, p.returncode, time.time() - start)
+            expired[index] = timer.fired
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(limit, len(cmds)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return(results, expired)
+
+
+def stream_shell(args, cmd, echo=False, timeout=None):
+    '''Run a shell command and yield its output one line at a time
+
+    stderr is merged into stdout so the lines come out in the order they
+    were written. Lines are displayed as they arrive if echo is set or debug
+    is enabled, and appended to the --stream_log file if one was given, so
+    only the current line is held in memory unless a trace is recorded.
+
+    Timeouts are handled as in run_shell, CommandTimeoutException is raised
+    after the last line that was read before the command was killed. If
+    the caller stops reading early the command is stopped, which is how a
+    watch that never ends by itself is finished with.
+    '''
+
+    print_shell_cmd(args, cmd)
+
+    timeout = command_timeout(args, cmd, timeout)
+    mark = profile_start()
+    if replaying():
+        p = None
+        lines = TRACE.replay(cmd)[0].splitlines(True)
+    else:
+        p = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            shell=True,
+            preexec_fn=os.setpgrp)
+        timer = ProcessGroupTimer(p, timeout)
+        lines = iter(p.stdout.readline, b'')
+
+    log = None
+    if args.stream_log:
+        log = open(args.stream_log, 'ab')
+    recorded = []
+    nbytes = 0
+    finished = False
+    start = time.time()
+    try:
+        for line in lines:
+            nbytes += len(line)
+            if TRACE is not None and p is not None:
+                recorded.append(line)
+            if log is not None:
+                log.write(line)
+                log.flush()
+            line = line.rstrip()
+            if echo or args.verbose == 10:  # Hack - debug enabled
+                print(line)
+            yield line
+        finished = True
+    finally:
+        if p is not None:
+            if not finished and p.poll() is None:
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            p.stdout.close()
+            p.wait()
+            timer.cancel()
+        if log is not None:
+            log.close()
+        profile_end(mark, cmd, nbytes)
+        if p is not None and TRACE is not None:
+            TRACE.record(cmd, b''.join(recorded), b'', p.returncode,
+                         time.time() - start,
+                         timeout if timer.fired else None)
+
+    if p is not None and timer.fired:
+        raise CommandTimeoutException(cmd, timeout)
+
+
+def command_timeout(args, cmd, timeout=None):
+    '''Return the timeout in seconds to run cmd with, None for no limit
+
+    An explicit timeout wins, then --timeout, then the first COMMAND_TIMEOUTS
+    class the command's executable is in. Whichever it is, it is cut to what
+    is left of --deadline.
+    '''
+
+    if timeout is None:
+        timeout = args.timeout
+    if timeout is None:
+        command = re.sub(r'^sudo\s+((-[ugCDhpr]\s+\S+|-\S+)\s+)*', '',
+                         cmd.strip())
+        for pattern, seconds in COMMAND_TIMEOUTS:
+            if re.match(pattern + r'(\s|$)', command):
+                timeout = seconds
+                break
+    return(time_left(timeout))
+
+
+def own_process_group(terminal=None):
+    '''Return a preexec_fn starting a command in its own process group
+
+    The whole group can then be killed on a timeout, see
+    kill_process_group(). Unlike a new session the command keeps the
+    terminal, and given the terminal from foreground_terminal() the group
+    is put in the foreground of it too, so sudo can prompt for a password.
+    '''
+
+    def preexec():
+        os.setpgrp()
+        if terminal is not None:
+            # Only the foreground group may change it, unless SIGTTOU is
+            # ignored
+            signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+            os.tcsetpgrp(terminal, os.getpgrp())
+            signal.signal(signal.SIGTTOU, signal.SIG_DFL)
+    return(preexec)
+
+
+def foreground_terminal():
+    '''Return the terminal the script is in the foreground of, None if none
+
+    Only commands run from the main thread are given the terminal, one at
+    a time, never those run concurrently from other threads.
+    '''
+
+    if threading.current_thread() is not MAIN_THREAD:
+        return(None)
+    try:
+        fd = sys.stdin.fileno()
+        if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+            return(fd)
+    except (AttributeError, ValueError, OSError):
+        pass
+    return(None)
+
+
+def take_terminal(terminal, proc):
+    '''Put the script back in the foreground of terminal once proc is done
+
+    A Ctrl-C while proc had the terminal only reached proc, it is raised
+    again here as if the script had got it as well.
+    '''
+
+    if terminal is None:
+        return
+    handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        os.tcsetpgrp(terminal, os.getpgrp())
+    finally:
+        signal.signal(signal.SIGTTOU, handler)
+    if proc.returncode in (-signal.SIGINT, 128 + signal.SIGINT):
+        raise KeyboardInterrupt()
+
+
+def kill_process_group(pgid, grace=5):
+    '''SIGTERM a process group, then SIGKILL whatever is left after grace
+
+    A grace of None only sends the SIGTERM, E.g. at exit where a timer
+    thread would no longer run.
+    '''
+
+    def kill(sig):
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            # Already gone, or a sudo child we are not allowed to signal
+            pass
+
+    # Not a daemon, so the SIGKILL still happens if the script is exiting
+    kill(signal.SIGTERM)
+    if grace is None:
+        return
+    timer = threading.Timer(grace, kill, [signal.SIGKILL])
+    timer.daemon = False
+    timer.start()
+
+
+class ProcessGroupTimer(object):
+    '''Kill a process and everything it started once timeout expires
+
+    The process must have been started in its own process group, see
+    own_process_group(), so that its pid is also the process group id.
+    '''
+
+    # Timers of the commands still running, see kill_commands()
+    running = set()
+
+    def __init__(self, proc, timeout):
+        self.proc = proc
+        self.fired = False
+        self.timer = None
+        self.thread = threading.current_thread()
+        ProcessGroupTimer.running.add(self)
+        if timeout:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        self.fired = True
+        kill_process_group(self.proc.pid)
+
+    def cancel(self):
+        ProcessGroupTimer.running.discard(self)
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def kill_commands(thread):
+    '''Kill the commands a thread is running, as if they had timed out
+
+    E.g. the kubectl watch of a PodInformer being stopped, which would
+    otherwise outlive the script. Return how many were killed.
+    '''
+
+    killed = 0
+    for timer in list(ProcessGroupTimer.running):
+        if timer.thread is thread:
+            timer.fired = True
+            kill_process_group(timer.proc.pid, grace=None)
+            killed += 1
+    return(killed)
+
+
 def untar(fname):
     '''Untar a tarred and compressed file'''
 
+    if replaying():
+        return
+
     if (fname.endswith("tar.gz")):
         tar = tarfile.open(fname, "r:gz")
         tar.extractall()
@@ -236,72 +1925,132 @@ def banner(description):
     print('\n')
 
 
+# The curl that curl() runs, E.g. a stand-in of bench_deploy.py
+CURL_PATH = '/usr/bin/curl'
+
+
 def curl(*args):
-    '''Use curl to retrieve a file from a URI'''
+    '''Use curl to retrieve a file from a URI
+
+    In a trace the command is kept as "curl ...", whichever curl ran it.
+    '''
 
-    curl_path = '/usr/bin/curl'
-    curl_list = [curl_path]
+    curl_list = [CURL_PATH]
     for arg in args:
         curl_list.append(arg)
-    curl_result = subprocess.Popen(
+    cmd = ' '.join(['curl'] + curl_list[1:])
+    mark = profile_start()
+    if replaying():
+        return(TRACE.replay(cmd)[0])
+
+    start = time.time()
+    p = subprocess.Popen(
         curl_list,
         stderr=subprocess.PIPE,
-        stdout=subprocess.PIPE).communicate()[0]
+        stdout=subprocess.PIPE)
+    curl_result, err = p.communicate()
+    if TRACE is not None:
+        TRACE.record(cmd, curl_result, err, p.returncode, time.time() - start)
+    profile_end(mark, 'curl', len(curl_result) + len(err))
     return curl_result
 
 
-def linux_ver(args):
-    '''Determine Linux version'''
-
-    find_os = platform.linux_distribution()
-    if re.search('Centos', find_os[0], re.IGNORECASE):
-        linux = 'centos'
-    elif re.search('Ubuntu', find_os[0], re.IGNORECASE):
-        linux = 'ubuntu'
-    else:
-        find_os = run_shell(args, "cat /proc/version | cut -d' ' -f3")
-        if re.search('flatcar', find_os, re.IGNORECASE):
-            linux = 'container'
-        elif re.search('coreos', find_os, re.IGNORECASE):
-            linux = 'container'
-        else:
-            print('Linux "%s" is not supported yet' % find_os[0])
-            sys.exit(1)
-
-    return(linux)
+# Command printing the version of each tool that is looked up, see
+# ToolVersions
+VERSION_PROBES = collections.OrderedDict([
+    ('docker', 'docker --version'),
+    ('kubectl', 'kubectl version --client'),
+])
 
 
-def linux_ver_det():
-    '''Determine detailed Linux version - Ubuntu or Centos
+def which(name):
+    '''Return the path of an executable on the PATH, None if there is none'''
 
-    Return OS, OS Versions
-    '''
-
-    return(platform.linux_distribution()[0],
-           platform.linux_distribution()[1],
-           platform.linux_distribution()[2])
-
-
-def k8s_ver(args):
-    '''Display kubernetes version'''
-
-    oldstr = run_shell(
-        args,
-        "kubectl version | grep 'Client Version' "
-        "| awk '{print $5}' | cut -d '\"' -f2")
-    return(oldstr)
-    newstr = oldstr.replace(",", "")
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return(path)
+    return(None)
 
-    return(newstr.rstrip())
 
+class ToolVersions(object):
+    '''Versions of the installed tools, see VERSION_PROBES
 
-def docker_ver(args):
-    '''Display Docker version'''
+    Every tool is probed at once at startup. Each version is kept with the
+    path and mtime of the tool's binary, so a lookup costs a stat. A tool
+    that has been installed, upgraded or removed since it was probed is
+    probed again.
 
-    oldstr = run_shell(args, "docker --version | awk '{print $3}'")
-    newstr = oldstr.replace(",", "")
+    With --versions_cache the versions are kept in that file too, and only
+    the tools that changed since are probed at startup.
+    '''
 
-    return(newstr.rstrip())
+    def __init__(self, args):
+        self.args = args
+        self.path = args.versions_cache and \
+            os.path.expanduser(args.versions_cache)
+        self.entries = {}
+        if self.path and not replaying() and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+        self.probe([tool for tool in VERSION_PROBES if self.stale(tool)])
+
+    def stamp(self, tool):
+        '''Return [path, mtime] of what a tool's version depends on'''
+
+        path = which(tool)
+        if path is None:
+            return(None)
+        try:
+            return([path, os.stat(path).st_mtime])
+        except OSError:
+            return(None)
+
+    def stale(self, tool):
+        # Replayed versions can not change, and the binaries of this host
+        # have nothing to do with them
+        if tool in self.entries and replaying():
+            return(False)
+        entry = self.entries.get(tool)
+        return(entry is None or entry['stamp'] != self.stamp(tool))
+
+    def probe(self, tools):
+        '''Probe the versions of tools concurrently, and keep them'''
+
+        if not tools:
+            return
+        outputs = run_many(self.args, [VERSION_PROBES[tool] for tool in tools],
+                           limit=len(tools), timeout=60)
+        for tool, out in zip(tools, outputs):
+            if not isinstance(out, str):
+                out = out.decode('utf-8', 'replace')
+            version = re.search(r'v?\d+\.\d+[\w.+-]*', out)
+            entry = {'version': version.group(0) if version else None,
+                     'output': out}
+            self.entries[tool] = entry
+            entry['stamp'] = self.stamp(tool)
+
+        if self.path and not replaying():
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f)
+
+    def entry(self, tool):
+        if self.stale(tool):
+            self.probe([tool])
+        return(self.entries[tool])
+
+    def get(self, tool):
+        '''Return the version of a tool, E.g: v1.10.0, None if it is missing'''
+
+        return(self.entry(tool)['version'])
+
+    def output(self, tool):
+        '''Return all the version output of a tool'''
+
+        return(self.entry(tool)['output'])
 
 
 def helm_version(args, str):
@@ -341,26 +2090,29 @@ def print_versions(args):
     '''
 
     print('\n  Linux Host Info:')
-    os, os_ver, os_ver_s = linux_ver_det()
-    print('    OS:                %s' % os)
-    print('    OS version:        %s' % os_ver)
-    print('    OS version str:    %s' % os_ver_s)
+    distro, distro_ver, distro_ver_s = args.facts.distribution
+    print('    OS:                %s' % distro)
+    print('    OS version:        %s' % distro_ver)
+    print('    OS version str:    %s' % distro_ver_s)
+    print('    Kernel:            %s' % args.facts.kernel)
+    print('    CPUs, memory:      %d, %d MiB'
+          % (args.facts.cpus, (args.facts.memory or 0) // 2 ** 20))
 
     print('\n  Networking Info:')
     print('    CNI/SDN:            %s' % args.cni)
 
     print('\n  Tool Versions:')
-    print('    Docker version:     %s' % docker_ver(args))
+    print('    Docker version:     %s' % args.versions.get('docker'))
     print('    Helm version:       %s' % helm_version(args, 'helm'))
-    print('    K8s version:        %s' % k8s_ver(args).rstrip())
+    print('    K8s version:        %s' % args.versions.get('kubectl'))
     print('\n')
-    time.sleep(2)
+    sleep(2)
 
 
 def k8s_create_repo(args):
     '''Create a k8s repository file'''
 
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         name = './kubernetes.repo'
         repo = '/etc/yum.repos.d/kubernetes.repo'
         with open(name, "w") as w:
@@ -378,7 +2130,7 @@ exclude=kube*
 """)
         # todo: add -H to all sudo's see if it works in both envs
         run_shell(args, 'sudo mv ./kubernetes.repo %s' % repo)
-    elif linux_ver(args) == 'ubuntu':
+    elif args.facts.linux == 'ubuntu':
         run_shell(args,
                   'curl -s https://packages.cloud.google.com'
                   '/apt/doc/apt-key.gpg '
@@ -398,7 +2150,6 @@ def k8s_wait_for_kube_system(args):
 
     TIMEOUT = 2000  # Give k8s 2000s to come up
     RETRY_INTERVAL = 10
-    elapsed_time = 0
     prev_cnt = 0
     base_pods = 7
 
@@ -406,38 +2157,28 @@ def k8s_wait_for_kube_system(args):
           'Kubernetes infrastructure'
           % (PROGRESS, K8S_FINAL_PROGRESS, (time.time() - start_time)))
 
-    while True:
-        pod_status = run_shell(args,
-                               'kubectl get pods -n kube-system --no-headers')
-
-        nlines = len(pod_status.splitlines())
+    poller = Poller(TIMEOUT, ceiling=RETRY_INTERVAL)
+    detector = FailureDetector(args, 'kube-system')
+    prev_cnt = None
+    table = PodTable()
+    for table in pod_updates(args, poller, 'kube-system'):
+        detector.check(table.not_ready())
+        nlines = len(table)
         if nlines >= base_pods:
             print(
                 '  *All pods %s/%s are started, continuing*' %
                 (nlines, base_pods))
-            run_shell(args, 'kubectl get pods -n kube-system')
             break
-        elif elapsed_time < TIMEOUT:
-            if nlines < 0:
-                cnt = 0
-            else:
-                cnt = nlines
-
-            if elapsed_time is not 0:
-                if cnt is not prev_cnt:
-                    print(
-                        "  *Running/Pending pod status after %ds %s/%s*"
-                        % (elapsed_time, cnt, base_pods))
-            prev_cnt = cnt
-            time.sleep(RETRY_INTERVAL)
-            elapsed_time = elapsed_time + RETRY_INTERVAL
-            continue
-        else:
-            # Dump verbose output in case it helps...
-            print(pod_status)
-            raise AbortScriptException(
-                "Kubernetes - did not come up after {0} seconds!"
-                .format(elapsed_time))
+        if prev_cnt is not None and nlines != prev_cnt:
+            print("  *Running/Pending pod status after %ds %s/%s*"
+                  % (poller.elapsed(), nlines, base_pods))
+        prev_cnt = nlines
+    else:
+        # Dump verbose output in case it helps...
+        print(table.format())
+        raise AbortScriptException(
+            "Kubernetes - did not come up after {0} seconds!"
+            .format(int(poller.elapsed())))
     add_one_to_progress()
 
 
@@ -447,72 +2188,711 @@ def k8s_wait_for_pod_start(args, chart):
     # Useful for debugging issues when Service fails to start
     return
 
-    time.sleep(3)
-
+    poller = Poller(ceiling=3)
     while True:
-        chart_up = run_shell(args,
-                             'kubectl get pods --no-headers --all-namespaces'
-                             ' | grep -i "%s" | wc -l' % chart)
-        if int(chart_up) == 0:
+        table = pod_table(args, poller) or PodTable()
+        chart_up = len(table.select(match=chart))
+        if chart_up == 0:
             print('  *Kubernetes - chart "%s" not started yet*' % chart)
-            time.sleep(3)
+            poller.wait()
             continue
         else:
             print('  *Kubernetes - chart "%s" is started*' % chart)
             break
 
 
-def k8s_wait_for_running_negate(args, timeout=None):
-    '''Query get pods until only state is Running'''
+def pod_status(pod):
+    '''Return the STATUS kubectl would show for a pod parsed from JSON'''
 
-    if timeout is None:
-        TIMEOUT = 500
+    if pod['metadata'].get('deletionTimestamp'):
+        return('Terminating')
+    init = pod['status'].get('initContainerStatuses', [])
+    for index, container in enumerate(init):
+        state = container.get('state', {})
+        terminated = state.get('terminated')
+        if terminated and terminated.get('exitCode') == 0:
+            continue
+        if terminated:
+            return('Init:%s' % terminated.get('reason', 'Error'))
+        reason = state.get('waiting', {}).get('reason', 'PodInitializing')
+        if reason != 'PodInitializing':
+            return('Init:%s' % reason)
+        return('Init:%d/%d' % (index, len(init)))
+    for container in pod['status'].get('containerStatuses', []):
+        state = container.get('state', {})
+        if state.get('waiting'):
+            return(state['waiting'].get('reason', 'Waiting'))
+        if state.get('terminated'):
+            return(state['terminated'].get('reason', 'Terminated'))
+    return(pod['status'].get('phase', 'Unknown'))
+
+
+def list_pods(args, namespace=None, poller=None, selector=None):
+    '''Return the pods, of all namespaces by default, as a parsed PodList
+
+    The pods come from the API with --kube_api, otherwise from kubectl. Only
+    those matching the label selector are listed if there is one.
+    None is returned if they could not be listed, E.g. while etcd is busy,
+    which poller is told about so that it backs off.
+    '''
+
+    if args.kube_api:
+        try:
+            return(kube_client().list('pods', namespace, selector))
+        except (KubeApiException, httplib.HTTPException, socket.error) as e:
+            error = e
     else:
-        TIMEOUT = timeout
+        cmd = ['kubectl', 'get', 'pods', '-o', 'json']
+        cmd += (['-n', namespace] if namespace else ['--all-namespaces'])
+        if selector:
+            cmd += ['-l', selector]
+        result = run_result(args, cmd)
+        if result.rc == 0:
+            return(json.loads(result.stdout))
+        error = result.stderr
+    if overload_error(error):
+        print('Kubernetes - etcdserver is busy - '
+              'retrying after brief pause')
+        if poller is not None:
+            poller.overloaded()
+    return(None)
+
+
+class Poller(object):
+    '''Schedule the probes of a wait loop
+
+    The first probes come quickly, then the interval grows exponentially up
+    to ceiling, with jitter so that waits do not probe in lockstep. While the
+    apiserver reports that it is overloaded, E.g. etcd timing out, the wait
+    backs off separately and for longer, until a probe gets through again.
+
+    wait() sleeps until the next probe, it returns False instead once the
+    timeout has expired. A timeout of None waits forever.
+
+    Unless deadline is False the timeout is cut to what is left of
+    --deadline, and DeadlineExceededException is raised instead of
+    expiring once that is spent.
+    '''
 
-    RETRY_INTERVAL = 10
+    def __init__(self, timeout=None, first=0.5, ceiling=10, factor=2,
+                 overload_first=2, overload_ceiling=15, deadline=True):
+        self.start = time.time()
+        self.deadline = deadline and DEADLINE is not None
+        if deadline:
+            timeout = time_left(timeout)
+        self.timeout = timeout
+        self.ceiling = ceiling
+        self.factor = factor
+        self.overload_first = overload_first
+        self.overload_ceiling = overload_ceiling
+        self.probes = 0
+        self.interval = first
+        self.overloads = 0
+        self.overload_pending = False
+
+    def elapsed(self):
+        return(time.time() - self.start)
+
+    def remaining(self):
+        '''Seconds left before the timeout, None for no timeout'''
+
+        if self.timeout is None:
+            return(None)
+        return(max(0, self.timeout - self.elapsed()))
+
+    def expired(self):
+        if self.remaining() != 0:
+            return(False)
+        if self.deadline:
+            DEADLINE.check()
+        return(True)
+
+    def overloaded(self):
+        '''Note that the last probe failed because the server is overloaded'''
+
+        self.overload_pending = True
+
+    def delay(self):
+        '''Return the seconds until the next probe, and advance the schedule'''
+
+        if self.overload_pending:
+            delay = min(self.overload_ceiling,
+                        self.overload_first * self.factor ** self.overloads)
+            self.overloads += 1
+            self.overload_pending = False
+        else:
+            delay = self.interval
+            self.interval = min(self.ceiling, self.interval * self.factor)
+            self.overloads = 0
+        # Up to half of the delay is random
+        return(delay / 2.0 + random.uniform(0, delay / 2.0))
+
+    def wait(self):
+        if self.expired():
+            return(False)
+        delay = self.delay()
+        if self.timeout is not None:
+            delay = min(delay, self.remaining())
+        sleep(delay)
+        self.probes += 1
+        return(True)
+
+
+def overload_error(error):
+    '''True if a kubectl or API error says the server is overloaded'''
+
+    if isinstance(error, KubeApiException):
+        if error.status in (429, 503, 504):
+            return(True)
+        error = error.body.decode('utf-8', 'replace')
+    return(re.search('request timed out|too many requests|'
+                     'unable to handle the request', str(error),
+                     re.IGNORECASE) is not None)
+
+
+# One row of a PodTable, job is the name of the Job that owns the pod,
+# release the helm release the pod belongs to and message says why a
+# container is waiting or terminated, if it does
+PodRow = collections.namedtuple(
+    'PodRow', 'namespace name phase ready containers restarts reason job '
+    'release serving message')
+
+
+class PodTable(object):
+    '''One snapshot of every pod, reduced to what the wait loops look at
+
+    Each pod is kept as a PodRow, where reason is the STATUS kubectl would
+    show, see pod_status(). Built from one listing of all namespaces, so a
+    wait loop needs a single list per tick whatever it waits for.
+    '''
+
+    def __init__(self, listing=None):
+        self.rows = {}
+        self.resource_version = None
+        if listing is not None:
+            self.resource_version = listing.get('metadata', {}).get(
+                'resourceVersion')
+            for pod in listing['items']:
+                self.add(pod)
+
+    def __len__(self):
+        return(len(self.rows))
+
+    def add(self, pod):
+        meta = pod['metadata']
+        statuses = pod['status'].get('containerStatuses', [])
+        phase = pod['status'].get('phase', 'Unknown')
+        ready = len([c for c in statuses if c.get('ready')])
+        containers = len(pod.get('spec', {}).get('containers', statuses))
+        reason = pod_status(pod)
+        jobs = [owner['name'] for owner in meta.get('ownerReferences', [])
+                if owner.get('kind') == 'Job']
+        messages = [state.get('message', '').strip()
+                    for container in
+                    pod['status'].get('initContainerStatuses', []) + statuses
+                    for state in container.get('state', {}).values()]
+
+        # Serving once the Ready condition says so, or without conditions
+        # once every container is ready
+        conditions = dict((c['type'], c['status'])
+                          for c in pod['status'].get('conditions', []))
+        if 'Ready' in conditions:
+            serving = conditions['Ready'] == 'True'
+        else:
+            serving = containers > 0 and ready == containers
+        serving = serving and phase == 'Running' and reason != 'Terminating'
+
+        row = PodRow(meta.get('namespace', ''), meta['name'], phase, ready,
+                     containers,
+                     sum(c.get('restartCount', 0) for c in statuses),
+                     reason, jobs[0] if jobs else None,
+                     meta.get('labels', {}).get('release'), serving,
+                     ([m for m in messages if m] or [''])[0])
+        self.rows[(row.namespace, row.name)] = row
+
+    def update(self, pod):
+        '''Apply a pod from watch_pods, which drops it once it is deleted'''
+
+        meta = pod['metadata']
+        if meta.get('deletionTimestamp'):
+            self.rows.pop((meta.get('namespace', ''), meta['name']), None)
+        else:
+            self.add(pod)
 
-    print('  Wait for all pods to be in Running state:')
+    def filter(self, namespace=None, releases=None):
+        '''Return a new table of the rows of namespace and of helm releases
 
-    elapsed_time = 0
-    prev_not_running = 0
-    while True:
-        etcd_check = run_shell(
-            args,
-            'kubectl get pods --no-headers --all-namespaces'
-            ' | grep -i "request timed out" | wc -l')
-
-        if int(etcd_check) != 0:
-            print('Kubernetes - etcdserver is busy - '
-                  'retrying after brief pause')
-            time.sleep(15)
+        Without either the new table is a copy of this one.
+        '''
+
+        table = PodTable()
+        table.resource_version = self.resource_version
+        table.rows = dict((key, row) for key, row in self.rows.items()
+                          if namespace in (None, row.namespace) and
+                          (not releases or row.release in releases))
+        return(table)
+
+    def select(self, namespace=None, match=None):
+        '''Return the rows of a namespace and/or with match in their name'''
+
+        return([row for key, row in sorted(self.rows.items())
+                if namespace in (None, row.namespace) and
+                (match is None or match.lower() in row.name.lower())])
+
+    def not_ready(self, namespace=None):
+        '''Return the rows of pods that are still to be waited for
+
+        A pod is done once it is Running and Ready, or once it Succeeded as
+        the pods of a Job do. A failed pod of a Job that then succeeded with
+        another pod was only a retry, so it is done too.
+        '''
+
+        succeeded = set((row.namespace, row.job)
+                        for row in self.rows.values()
+                        if row.job and row.phase == 'Succeeded')
+        return([row for row in self.select(namespace)
+                if not (row.serving or row.phase == 'Succeeded' or
+                        (row.phase == 'Failed' and
+                         (row.namespace, row.job) in succeeded))])
+
+    def breakdown(self, rows=None, column='namespace'):
+        '''Return "value count, ..." of a column for rows, by default all'''
+
+        if rows is None:
+            rows = self.select()
+        counts = collections.Counter(getattr(row, column) for row in rows)
+        return(', '.join('%s %d' % item for item in sorted(counts.items())))
+
+    def format(self, namespace=None):
+        '''Format the rows much like kubectl get pods does'''
+
+        return(format_columns(
+            [['NAMESPACE', 'NAME', 'READY', 'STATUS', 'RESTARTS']] +
+            [[row.namespace, row.name, '%d/%d' % (row.ready, row.containers),
+              row.reason, str(row.restarts)]
+             for row in self.select(namespace)]))
+
+
+def pod_table(args, poller=None, namespace=None, selector=None):
+    '''Return a PodTable of every pod, None if they could not be listed
+
+    The table can be limited to a namespace and a label selector as with
+    list_pods.
+    '''
+
+    listing = list_pods(args, namespace, poller, selector)
+    if listing is None:
+        return(None)
+    return(PodTable(listing))
+
+
+# STATUS of a pod that is on its way up, see pod_status()
+STARTING_REASONS = ['Pending', 'ContainerCreating', 'PodInitializing',
+                    'Running', 'Completed', 'Terminating']
+
+# Waiting reasons that no amount of waiting will fix
+TERMINAL_REASONS = ['InvalidImageName', 'ErrImageNeverPull']
+
+# An image pull failing like this is a wrong image name or tag
+MISSING_IMAGE = ('not found|manifest unknown|does not exist|'
+                 'pull access denied|unauthorized')
+
+
+def list_events(args, namespace=None):
+    '''Return the Warning events about pods, {(namespace, name): [message]}
+
+    Events come from the API with --kube_api, otherwise from kubectl. Only
+    the most recent of each reason is kept. Nothing is returned if they
+    could not be listed, the events only add detail to a pod's own status.
+    '''
+
+    if args.kube_api:
+        try:
+            listing = kube_client().list('events', namespace)
+        except (KubeApiException, httplib.HTTPException, socket.error):
+            return({})
+    else:
+        cmd = ['kubectl', 'get', 'events', '-o', 'json']
+        cmd += (['-n', namespace] if namespace else ['--all-namespaces'])
+        result = run_result(args, cmd)
+        if result.rc != 0:
+            return({})
+        listing = json.loads(result.stdout)
+
+    latest = {}
+    for event in listing['items']:
+        pod = event.get('involvedObject', {})
+        if event.get('type') != 'Warning' or pod.get('kind') != 'Pod':
+            continue
+        key = (pod.get('namespace', ''), pod.get('name'))
+        latest.setdefault(key, {})[event.get('reason')] = '%s: %s' % (
+            event.get('reason'), event.get('message', '').strip())
+    return(dict((key, sorted(reasons.values()))
+                for key, reasons in latest.items()))
+
+
+def pod_starting(row):
+    '''True if a pod is on its way up as far as its status shows'''
+
+    return(row.reason in STARTING_REASONS or
+           re.match(r'Init:\d+/\d+$', row.reason) is not None)
+
+
+def pod_failure(row, events=()):
+    '''Classify why a pod is not coming up
+
+    Return None if the pod is just starting, otherwise (terminal, why) where
+    terminal is True if waiting can not help, E.g. the image does not exist.
+    events are the pod's messages from list_events.
+
+    A crash looping pod is never terminal however often it restarted, kolla
+    pods crash many times while mariadb, rabbitmq and keystone come up, the
+    wait's own timeout bounds it.
+    '''
+
+    if pod_starting(row):
+        return(None)
+
+    reason = row.reason.split(':')[-1]
+    why = '; '.join([row.reason] + [m for m in [row.message] if m] +
+                    list(events))
+    if reason in TERMINAL_REASONS:
+        return(True, why)
+    if reason in ('ErrImagePull', 'ImagePullBackOff'):
+        return(re.search(MISSING_IMAGE, why, re.IGNORECASE) is not None, why)
+    if reason == 'CrashLoopBackOff':
+        return(False, '%s after %d restarts' % (why, row.restarts))
+    return(False, why)
+
+
+class FailureDetector(object):
+    '''Spot the pods of a wait loop that are failing rather than starting
+
+    check() is given the rows still waited for. A terminal failure aborts
+    the script straight away, a transient one is reported once. Events are
+    only listed when a pod shows a new sign of trouble, so a wait where all
+    is well costs nothing extra.
+    '''
+
+    def __init__(self, args, namespace=None):
+        self.args = args
+        self.namespace = namespace
+        self.seen = set()
+        self.reported = set()
+
+    def check(self, rows):
+        suspects = [row for row in rows if not pod_starting(row)]
+        signs = set((row.namespace, row.name, row.reason, row.restarts)
+                    for row in suspects)
+        if not signs - self.seen:
+            return
+        self.seen |= signs
+
+        events = list_events(self.args, self.namespace)
+        for row in suspects:
+            failure = pod_failure(row, events.get((row.namespace, row.name),
+                                                  []))
+            if failure is None:
+                continue
+            terminal, why = failure
+            if terminal:
+                raise AbortScriptException(
+                    'Kubernetes - pod %s/%s will not start: %s'
+                    % (row.namespace, row.name, why))
+            if (row.namespace, row.name, why) not in self.reported:
+                self.reported.add((row.namespace, row.name, why))
+                print('    *Pod %s/%s is failing, still waiting: %s*'
+                      % (row.namespace, row.name, why))
+
+
+def watch_pods(args, timeout, resource_version=None, namespace=None,
+               selector=None):
+    '''Yield every pod, or those of namespace and selector, as it changes
+
+    With --kube_api the pods are watched from resource_version, E.g. that
+    of a PodTable, and the watch ends after timeout seconds. A deleted pod
+    is yielded with a deletionTimestamp.
+
+    Otherwise "kubectl get pods -w" yields all current pods first, then
+    each pod again whenever it changes. kubectl prints one indented JSON
+    object per pod, so an object is only decoded once its closing brace
+    arrives. CommandTimeoutException is raised after timeout seconds.
+    '''
+
+    if args.kube_api:
+        for kind, pod in kube_client().watch('pods', namespace,
+                                             resource_version, timeout,
+                                             selector):
+            if kind == 'ERROR':
+                # E.g. the resource version is too old, list again
+                return
+            if kind == 'DELETED':
+                pod['metadata'].setdefault('deletionTimestamp', 'deleted')
+            yield(pod)
+        return
+
+    cmd = 'kubectl get pods -o json -w'
+    cmd += (' -n %s' % namespace if namespace else ' --all-namespaces')
+    if selector:
+        cmd += " -l '%s'" % selector
+    decoder = json.JSONDecoder()
+    lines = []
+    for line in stream_shell(args, cmd, timeout=timeout):
+        if not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        if not lines and not line.startswith('{'):
+            # Not JSON, E.g. a warning or an etcd error
             continue
+        lines.append(line)
+        if line == '}':
+            yield(decoder.raw_decode('\n'.join(lines))[0])
+            lines = []
+
+
+class PodInformer(object):
+    '''Keep a PodTable of every pod up to date, see --informer
+
+    A background thread lists the pods, then watches them from the
+    resourceVersion of that list, listing again whenever the watch ends.
+    The waiters and reporters read the cache through wait() instead
+    of each listing the pods themselves, so the apiserver sees one watch
+    however many of them there are.
+
+    Only pods are cached. Nothing reads the nodes more than once, and the
+    Service that kolla_final_messages reads or the kubectl exec of
+    k8s_check_nslookup are not pod listings, so those still go to the
+    apiserver.
+    '''
+
+    # Seconds a watch runs before the pods are listed again
+    WATCH_TIMEOUT = 300
+
+    def __init__(self, args):
+        self.args = args
+        self.table = None
+        self.generation = 0
+        self.stopped = False
+        self.changed = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def publish(self, table=None, pod=None):
+        with self.changed:
+            if table is not None:
+                self.table = table
+            else:
+                self.table.update(pod)
+            self.generation += 1
+            self.changed.notify_all()
+
+    def run(self):
+        try:
+            self.follow()
+        except DeadlineExceededException:
+            # The main thread aborts the deployment
+            pass
+
+    def follow(self):
+        poller = Poller(ceiling=10, deadline=False)
+        while not self.stopped:
+            table = pod_table(self.args, poller)
+            if table is None:
+                poller.wait()
+                continue
+            poller = Poller(ceiling=10, deadline=False)
+            self.publish(table)
+
+            start = time.time()
+            watch = watch_pods(self.args, self.WATCH_TIMEOUT,
+                               table.resource_version)
+            try:
+                for pod in watch:
+                    if self.stopped:
+                        break
+                    self.publish(pod=pod)
+            except (CommandTimeoutException, httplib.HTTPException,
+                    socket.error):
+                pass
+            finally:
+                watch.close()
+            if self.stopped:
+                break
+            if time.time() - start < self.WATCH_TIMEOUT:
+                # The watch ended early, E.g. the apiserver restarted
+                poller.wait()
+
+    def wait(self, generation=None, timeout=None, namespace=None,
+             releases=None):
+        '''Return (generation, PodTable) once the pods changed after generation
+
+        Without a generation the current table is returned at once, unless
+        the pods are still to be listed. Waits for up to timeout seconds,
+        None is returned for the table if the pods have not been listed by
+        then. The table is a copy that the caller may keep, limited to
+        namespace and releases as with PodTable.filter.
+        '''
+
+        with self.changed:
+            if self.table is None or (generation is not None and
+                                      self.generation <= generation):
+                self.changed.wait(timeout)
+            if self.table is None:
+                return(self.generation, None)
+            return(self.generation, self.table.filter(namespace, releases))
+
+    def stop(self):
+        '''Stop the thread, and the kubectl watch it may be running'''
+
+        self.stopped = True
+        # Let the thread see its watch end before the interpreter goes away,
+        # an API watch cannot be interrupted but holds no process either
+        if kill_commands(self.thread):
+            self.thread.join(5)
+
+
+def pod_informer(args):
+    '''Return the shared PodInformer, starting it on first use
+
+    None is returned without --informer, and with a trace as the commands
+    of the thread could not be replayed in order.
+    '''
+
+    global POD_INFORMER
+    if not args.informer or TRACE is not None:
+        return(None)
+    if POD_INFORMER is None:
+        POD_INFORMER = PodInformer(args)
+        atexit.register(POD_INFORMER.stop)
+    return(POD_INFORMER)
+
+
+def pod_updates(args, poller, namespace=None, releases=None, tick=300):
+    '''Yield a PodTable of the pods waited for each time they change
+
+    A table is also yielded every tick seconds from the start whether or
+    not anything changed, and the pods are followed for as long as poller
+    has time left. They are listed and then watched, and listed again each
+    tick. With --informer they are only listed once, the cache of the
+    shared PodInformer may not have the pods that were just created yet,
+    and then followed through that cache. Only the pods of namespace and of
+    the helm releases are included if either is given.
+    '''
+
+    start = time.time()
+
+    def slice_time():
+        '''Return the seconds until the next tick, or the timeout'''
+
+        wait = tick - (time.time() - start) % tick
+        if poller.remaining() is not None:
+            wait = min(wait, poller.remaining())
+        return(max(0.1, wait))
+
+    selector = None
+    if releases:
+        selector = 'release in (%s)' % ','.join(releases)
+
+    informer = pod_informer(args)
+    if informer is not None:
+        generation = informer.generation
+        table = pod_table(args, poller, namespace, selector)
+        if table is not None:
+            yield(table)
+        while not poller.expired():
+            generation, table = informer.wait(generation, slice_time(),
+                                              namespace, releases)
+            if table is not None:
+                yield(table)
+        return
 
-        not_running = run_shell(
-            args,
-            'kubectl get pods --no-headers --all-namespaces | '
-            'grep -v "Running" | wc -l')
-
-        if int(not_running) != 0:
-            if prev_not_running != not_running:
-                print("    *%02d pod(s) are not in Running state*"
-                      % int(not_running))
-                time.sleep(RETRY_INTERVAL)
-                elapsed_time = elapsed_time + RETRY_INTERVAL
-                prev_not_running = not_running
+    while True:
+        table = pod_table(args, poller, namespace, selector)
+        if table is None:
+            if not poller.wait():
+                return
             continue
-        else:
-            print('    *All pods are in Running state*')
-            time.sleep(1)
-            break
+        yield(table)
+
+        begin = time.time()
+        wait = slice_time()
+        watch = watch_pods(args, max(1, wait), table.resource_version,
+                           namespace, selector)
+        try:
+            for pod in watch:
+                table.update(pod)
+                yield(table)
+        except (CommandTimeoutException, httplib.HTTPException,
+                socket.error):
+            pass
+        finally:
+            # Stops kubectl when the caller is done in the middle of it
+            watch.close()
+
+        if poller.expired():
+            return
+        if time.time() - begin < wait - 1:
+            # The watch ended early, E.g. the apiserver restarted
+            poller.wait()
+
+
+def k8s_wait_for_running_negate(args, timeout=None, releases=None):
+    '''Wait until every pod is Ready, or Completed for the pods of Jobs
+
+    Each change to the pods is seen as soon as it happens instead of on the
+    next poll, see pod_updates() and PodTable.not_ready.
+    A pod that will never start aborts the wait, see FailureDetector.
+
+    Given a list of helm releases only their pods in the kolla namespace
+    are waited for, by the release label the charts give them. helm returns
+    before a release has created its pods, so a release without any is
+    waited for, for up to RELEASE_GRACE seconds in case it never has any.
+    '''
 
-        if elapsed_time > TIMEOUT:
-            # Dump verbose output in case it helps...
-            print(int(not_running))
-            raise AbortScriptException(
-                "Kubernetes did not come up after {0} seconds!"
-                .format(elapsed_time))
-        sys.exit(1)
+    if timeout is None:
+        TIMEOUT = 500
+    else:
+        TIMEOUT = timeout
+
+    RETRY_INTERVAL = 10
+
+    RELEASE_GRACE = 60
+
+    namespace = None
+    column = 'namespace'
+    if releases:
+        namespace = 'kolla'
+        column = 'release'
+        print('  Wait for the pods of %s to be Ready or Completed:'
+              % ', '.join(releases))
+    else:
+        print('  Wait for all pods to be Ready or Completed:')
+
+    def missing(table):
+        '''Return the releases that have no pods yet'''
+
+        return(set(releases or []) -
+               set(row.release for row in table.select()))
+
+    poller = Poller(TIMEOUT, ceiling=RETRY_INTERVAL)
+    detector = FailureDetector(args, namespace)
+    prev_not_ready = None
+    # Look again once the grace for releases without pods is over
+    for table in pod_updates(args, poller, namespace, releases,
+                             RELEASE_GRACE):
+        not_ready = table.not_ready()
+        detector.check(not_ready)
+        if not not_ready and (not missing(table) or
+                              poller.elapsed() >= RELEASE_GRACE):
+            print('    *All pods are Ready or Completed*')
+            return
+        if len(not_ready) != prev_not_ready:
+            print("    *%02d pod(s) are not Ready or Completed* (%s)"
+                  % (len(not_ready), table.breakdown(not_ready, column)))
+            prev_not_ready = len(not_ready)
+
+    raise AbortScriptException(
+        "Kubernetes did not come up after {0} seconds!".format(TIMEOUT))
 
 
 def add_one_to_progress():
@@ -532,6 +2912,11 @@ def clean_progress():
 def print_progress(process, msg, finalctr, add_one=False):
     '''Print a message with a progress account'''
 
+    if PROFILER is not None:
+        PROFILER.begin_step('%s - %s' % (process, msg))
+    if DEADLINE is not None:
+        DEADLINE.check()
+        DEADLINE.begin_step('%s - %s' % (process, msg))
     if add_one:
         add_one_to_progress()
 
@@ -550,14 +2935,15 @@ def k8s_install_tools(args):
                    'Installing packages',
                    K8S_FINAL_PROGRESS)
 
-    if linux_ver(args) == 'centos':
-        run_shell(args, 'sudo yum update -y')
+    if args.facts.linux == 'centos':
+        for line in stream_shell(args, 'sudo yum update -y'):
+            pass
         run_shell(args,
                   'sudo yum install -y qemu epel-release bridge-utils '
                   'python-pip python-devel libffi-devel gcc '
                   'openssl-devel sshpass crudini jq ansible curl lvm2')
     # Ubuntu doesn't need this - maybe legacy from openstack
-    # elif linux_ver(args) == 'ubuntu':
+    # elif args.facts.linux == 'ubuntu':
     #     run_shell(args, 'sudo apt-get update; sudo apt-get dist-upgrade -y '
     #               '--allow-downgrades --no-install-recommends')
     #     run_shell(args,
@@ -571,7 +2957,7 @@ def k8s_install_tools(args):
 
     #     run_shell(args, 'sudo apt autoremove -y && sudo apt autoclean')
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         # Container Linux
         # Very experimental - do all the work here for now
         whoami = run_shell(args, 'whoami')
@@ -616,13 +3002,14 @@ def k8s_install_tools(args):
                   'systemctl enable kubelet && systemctl start kubelet')
         return
 
-    if '18' in docker_ver(args) and 'ce' in docker_ver(args):
+    docker = args.versions.get('docker') or ''
+    if '18' in docker and 'ce' in docker:
         install_docker = False
     else:
         install_docker = True
 
     if install_docker:
-        if linux_ver(args) == 'centos':
+        if args.facts.linux == 'centos':
             # https://kubernetes.io/docs/setup/cri/
             run_shell(args,
                       'sudo yum remove -y docker docker-common docker-selinux '
@@ -698,14 +3085,14 @@ def k8s_install_tools(args):
 def k8s_setup_ntp(args):
     '''Setup NTP'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     print_progress('Kubernetes',
                    'Setup NTP',
                    K8S_FINAL_PROGRESS)
 
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         run_shell(args, 'sudo yum install -y ntp')
         run_shell(args, 'sudo systemctl enable ntpd.service')
         run_shell(args, 'sudo systemctl start ntpd.service')
@@ -717,13 +3104,13 @@ def k8s_setup_ntp(args):
 def k8s_turn_things_off(args):
     '''Currently turn off SELinux and Firewall'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     run_shell(args, 'sudo swapoff -a')
     run_shell(args, 'sudo modprobe br_netfilter')
 
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         print_progress('Kubernetes',
                        'Turn off SELinux',
                        K8S_FINAL_PROGRESS)
@@ -741,7 +3128,7 @@ def k8s_turn_things_off(args):
                    'Turn off firewall and ISCSID',
                    K8S_FINAL_PROGRESS)
 
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         run_shell(args, 'sudo systemctl stop firewalld')
         run_shell(args, 'sudo systemctl disable firewalld')
     else:
@@ -753,7 +3140,7 @@ def k8s_turn_things_off(args):
 def k8s_install_k8s(args):
     '''Necessary repo to install kubernetes and tools'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     print_progress('Kubernetes',
@@ -762,7 +3149,7 @@ def k8s_install_k8s(args):
 
     k8s_create_repo(args)
 
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         run_shell(args,
                   'sudo yum install -y kubelet kubeadm kubectl '
                   '--disableexcludes=kubernetes')
@@ -809,7 +3196,7 @@ def k8s_set_cgroup(args):
 def k8s_reload_service_files(args):
     '''Service files were modified so bring them up again'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     print_progress('Kubernetes',
@@ -823,7 +3210,7 @@ def k8s_reload_service_files(args):
 def k8s_start_kubelet(args):
     '''Start kubelet'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     print_progress('Kubernetes',
@@ -837,7 +3224,7 @@ def k8s_start_kubelet(args):
 def k8s_fix_iptables(args):
     '''Maybe Centos only but this needs to be changed to proceed'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         return
 
     reload_sysctl = False
@@ -848,7 +3235,8 @@ def k8s_fix_iptables(args):
     run_shell(args, 'sudo cp /etc/sysctl.conf /tmp')
     run_shell(args, 'sudo chmod 777 /tmp/sysctl.conf')
 
-    with open('/tmp/sysctl.conf', 'r+') as myfile:
+    with open('/tmp/sysctl.conf', 'a+') as myfile:
+        myfile.seek(0)
         contents = myfile.read()
         if not re.search('net.bridge.bridge-nf-call-ip6tables=1', contents):
             myfile.write('net.bridge.bridge-nf-call-ip6tables=1' + '\n')
@@ -864,7 +3252,7 @@ def k8s_fix_iptables(args):
 def k8s_deploy_k8s(args):
     '''Start the kubernetes master'''
 
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         cmd = '/opt/bin/kubeadm init'
     else:
         if args.cni == 'calico':
@@ -882,11 +3270,9 @@ def k8s_deploy_k8s(args):
     #                 'sudo kubeadm init --pod-network-cidr=10.1.0.0/16 '
     #                 '--service-cidr=10.3.3.0/24 '
     #                 '--ignore-preflight-errors=all')
-    out = run_shell(args, cmd)
-
     # Even in no-verbose mode, we need to display the join command to
     # enabled multi-node
-    for line in out.splitlines():
+    for line in stream_shell(args, cmd):
         if re.search('kubeadm join', line):
             global JOIN_CMD
             JOIN_CMD = line + ' --ignore-preflight-errors=all'
@@ -909,6 +3295,14 @@ def k8s_load_kubeadm_creds(args):
     run_shell(args, 'sudo chmod 777 %s' % kube)
     run_shell(args, 'sudo -H chown $(id -u):$(id -g) $HOME/.kube/config')
 
+    # The API client and informer read the new credentials on next use
+    global KUBE_CLIENT
+    global POD_INFORMER
+    KUBE_CLIENT = None
+    if POD_INFORMER is not None:
+        POD_INFORMER.stop()
+        POD_INFORMER = None
+
 
 def k8s_deploy_calico(args):
     '''Deploy CNI/SDN to K8s cluster'''
@@ -929,8 +3323,8 @@ def k8s_deploy_weave(args):
                    'Deploy pod network SDN using Weave CNI',
                    K8S_FINAL_PROGRESS)
 
-    weave_ver = run_shell(args,
-                          "echo $(kubectl version | base64 | tr -d '\n')")
+    weave_ver = base64.b64encode(
+        args.versions.output('kubectl').encode('utf-8')).decode('ascii')
     run_shell(args, 'sudo rm -rf /tmp/weave.yaml /tmp/ipalloc.txt')
 
     curl(
@@ -949,9 +3343,8 @@ def k8s_deploy_weave(args):
     run_shell(args, "sed -i '/fieldPath: spec.nodeName/ r "
               "/tmp/ipalloc.txt' /tmp/weave.yaml")
 
-    run_shell(
-        args,
-        'kubectl apply -f /tmp/weave.yaml')
+    # Fail now rather than wait on a pod network that will never start
+    run_shell(args, 'kubectl apply -f /tmp/weave.yaml', check=True)
     return
 
 
@@ -1059,7 +3452,7 @@ def k8s_install_deploy_helm(args):
          '-o',
          '/tmp/helm-v%s-linux-amd64.tar.gz' % args.helm_version)
     untar('/tmp/helm-v%s-linux-amd64.tar.gz' % args.helm_version)
-    if linux_ver(args) == 'container':
+    if args.facts.linux == 'container':
         run_shell(args, 'sudo mv -f linux-amd64/helm /opt/bin')
     else:
         run_shell(args, 'sudo mv -f linux-amd64/helm /usr/local/bin/helm')
@@ -1088,7 +3481,8 @@ def k8s_final_messages(args):
     print('3. Join command is also saved here: "%s"' % output_file_name)
     print()
 
-    banner('Kubernetes - Cluster ready for use')
+    banner('Kubernetes - Cluster ready for use after %ds'
+           % (time.time() - start_time))
 
 
 def is_running(args, process):
@@ -1128,13 +3522,12 @@ def k8s_destroy(args):
                    'Delete /var files and dirs',
                    K8S_DESTROY_PROGRESS)
 
-    run_shell(args, 'sudo rm -rf /var/etcd')
-    run_shell(args, 'sudo rm -rf /var/run/kubernetes/*')
-    run_shell(args, 'sudo rm -rf /var/lib/kubelet/*')
-    run_shell(args, 'sudo rm -rf /var/run/lock/kubelet.lock')
-    run_shell(args, 'sudo rm -rf /var/run/lock/api-server.lock')
-    run_shell(args, 'sudo rm -rf /var/run/lock/etcd.lock')
-    run_shell(args, 'sudo rm -rf /var/run/lock/kubelet.lock')
+    run_many(args, ['sudo rm -rf /var/etcd',
+                    'sudo rm -rf /var/run/kubernetes/*',
+                    'sudo rm -rf /var/lib/kubelet/*',
+                    'sudo rm -rf /var/run/lock/kubelet.lock',
+                    'sudo rm -rf /var/run/lock/api-server.lock',
+                    'sudo rm -rf /var/run/lock/etcd.lock'])
 
     print_progress('Kubernetes',
                    'Delete /tmp',
@@ -1220,9 +3613,9 @@ spec:
                    "Test 'nslookup kubernetes'",
                    K8S_FINAL_PROGRESS)
 
-    out = run_shell(args,
-                    'kubectl exec k8s-dns-test -- nslookup '
-                    'kubernetes | grep -i address | wc -l')
+    out = run_cmd(args, ['kubectl', 'exec', 'k8s-dns-test', '--',
+                         'nslookup', 'kubernetes'],
+                  grep('address', ignorecase=True), count())
     if int(out) != 2:
         print("  Warning 'nslookup kubernetes ' failed. YMMV continuing")
 
@@ -1232,48 +3625,61 @@ def k8s_verify_and_show(args):
 
     banner('Kubernetes - Verify and Show Deployment')
 
-    print('Determine IP and port information from Service:')
-    print(run_shell(args, 'kubectl get svc -n kube-system'))
-    print()
-
-    print('View all k8s namespaces:')
-    print(run_shell(args, 'kubectl get namespaces'))
-    print()
-
-    print('View all deployed services:')
-    print(run_shell(args, 'kubectl get deployment -n kube-system'))
-    print()
-
-    print('View configuration maps:')
-    print(run_shell(args, 'kubectl get configmap -n kube-system'))
-    print()
-
-    print('General Cluster information:')
-    print(run_shell(args, 'kubectl cluster-info'))
-    print()
-
-    print('View all jobs:')
-    print(run_shell(args, 'kubectl get jobs --all-namespaces'))
-    print()
-
-    print('View all deployments:')
-    print(run_shell(args, 'kubectl get deployments --all-namespaces'))
-    print()
-
-    print('View secrets:')
-    print(run_shell(args, 'kubectl get secrets'))
-    print()
-
-    print('View docker images')
-    print(run_shell(args, 'sudo docker images'))
-    print()
-
-    print('View deployed Helm Charts')
-    print(run_shell(args, 'helm list'))
-    print()
-
-    print('View final cluster:')
-    print(run_shell(args, 'kubectl get pods --all-namespaces'))
+    # These are all read-only so query them together, display in order
+    queries = [
+        ('Determine IP and port information from Service:',
+         'kubectl get svc -n kube-system'),
+        ('View all k8s namespaces:',
+         'kubectl get namespaces'),
+        ('View all deployed services:',
+         'kubectl get deployment -n kube-system'),
+        ('View configuration maps:',
+         'kubectl get configmap -n kube-system'),
+        ('General Cluster information:',
+         'kubectl cluster-info'),
+        ('View all jobs:',
+         'kubectl get jobs --all-namespaces'),
+        ('View all deployments:',
+         'kubectl get deployments --all-namespaces'),
+        ('View secrets:',
+         'kubectl get secrets'),
+        ('View docker images',
+         'sudo docker images'),
+        ('View deployed Helm Charts',
+         'helm list'),
+        ('View final cluster:',
+         'kubectl get pods --all-namespaces')]
+
+    listed = {}
+    if args.kube_api:
+        # (kind, namespace) of the queries the API client can answer
+        listed = {'kubectl get namespaces': ('namespaces', None),
+                  'kubectl get configmap -n kube-system':
+                      ('configmaps', 'kube-system'),
+                  'kubectl get secrets': ('secrets', 'default'),
+                  'kubectl get pods --all-namespaces': ('pods', None)}
+
+    informer = pod_informer(args)
+    table = None
+    if informer is not None:
+        table = informer.wait(timeout=0)[1]
+    if table is not None:
+        listed.pop('kubectl get pods --all-namespaces', None)
+
+    cmds = [cmd for title, cmd in queries if cmd not in listed]
+    if table is not None:
+        cmds.remove('kubectl get pods --all-namespaces')
+    outputs = dict(zip(cmds, run_many(args, cmds)))
+    for cmd, (kind, namespace) in listed.items():
+        outputs[cmd] = resource_table(kube_client().list(kind, namespace),
+                                      namespaces=namespace is None and
+                                      kind == 'pods')
+    if table is not None:
+        outputs['kubectl get pods --all-namespaces'] = table.format()
+    for title, cmd in queries:
+        print(title)
+        print(outputs[cmd])
+        print()
 
 
 def k8s_bringup_kubernetes_cluster(args):
@@ -1318,16 +3724,24 @@ def main():
     '''Main function.'''
 
     args = parse_args()
+    start_trace(args)
+    start_profile(args)
+    start_deadline(args)
+    host_facts(args)
+    args.versions = ToolVersions(args)
 
     # Force sudo early on
     run_shell(args, 'sudo -v')
+    if args.privileged_helper and not replaying():
+        privileged_helper()
+        keep_sudo_alive()
 
     global K8S_DESTROY_PROGRESS
     K8S_DESTROY_PROGRESS = 5
 
     # Ubuntu does not need the selinux step
     global K8S_FINAL_PROGRESS
-    if linux_ver(args) == 'centos':
+    if args.facts.linux == 'centos':
         K8S_FINAL_PROGRESS = 14
     else:
         K8S_FINAL_PROGRESS = 13